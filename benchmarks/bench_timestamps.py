@@ -0,0 +1,78 @@
+'''
+micro-benchmark of utils.timestamps.parse_timestamp against dateutil on the timestamps of a push payload.
+
+    python -m benchmarks.bench_timestamps path/to/archived_push.json [--repeat 20]
+
+the payload is any archived 1st push (tpd-archive 1st/processed), .json or .json.gz.
+every push re-sends the full showPrices / statusHistory lists, so --repeat simulates that many pushes of the same card.
+without a path a synthetic card (10 races x 12 runners x 60 ticks) is used.
+'''
+import sys
+import gzip
+import json
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import parse
+from utils.timestamps import parse_timestamp
+
+
+def collect_timestamps(data: dict) -> list[str]:
+    timestamps = []
+    for fixture in data.get('fixtures', []):
+        for race in fixture.get('races', []):
+            timestamps.extend(item['timestamp'] for item in race.get('statusHistory', []) if item.get('timestamp'))
+            for entry in race.get('entries', []):
+                timestamps.extend(item['timestamp'] for item in entry.get('showPrices', []) if item.get('timestamp'))
+    return timestamps
+
+
+def make_synthetic_payload(races: int = 10, runners: int = 12, ticks: int = 60) -> dict:
+    start = datetime(2025, 6, 7, 12, 0, tzinfo=timezone.utc)
+    return {'fixtures': [{'races': [{
+        'statusHistory': [{'timestamp': (start + timedelta(minutes=m)).isoformat().replace('+00:00', 'Z')} for m in range(5)],
+        'entries': [{
+            'showPrices': [{'timestamp': (start + timedelta(seconds=37 * t + r)).isoformat(timespec='milliseconds').replace('+00:00', 'Z')} for t in range(ticks)]
+        } for r in range(runners)],
+    } for _ in range(races)]}]}
+
+
+def run(name: str, parser, timestamps: list[str], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for value in timestamps:
+            parser(value)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {elapsed:8.4f} s  {elapsed / (len(timestamps) * repeat) * 1e6:8.3f} us/timestamp')
+    return elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('path', nargs='?')
+    arg_parser.add_argument('--repeat', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    if args.path:
+        opener = gzip.open if args.path.endswith('.gz') else open
+        with opener(args.path, 'rb') as f:
+            data = json.load(f)
+    else:
+        data = make_synthetic_payload()
+    timestamps = collect_timestamps(data)
+    if not timestamps:
+        sys.exit('no showPrices / statusHistory timestamps in payload')
+
+    mismatches = [value for value in timestamps if str(parse_timestamp(value)) != str(parse(value))]
+    print(f'timestamps: {len(timestamps)}, repeat: {args.repeat}, mismatches vs dateutil: {len(mismatches)}')
+
+    baseline = run('dateutil.parser.parse', parse, timestamps, args.repeat)
+    parse_timestamp.cache_clear()
+    uncached = run('fromisoformat (no cache)', parse_timestamp.__wrapped__, timestamps, args.repeat)
+    parse_timestamp.cache_clear()
+    cached = run('parse_timestamp (cached)', parse_timestamp, timestamps, args.repeat)
+    print(f'speed-up: {baseline / uncached:.1f}x uncached, {baseline / cached:.1f}x cached')
+
+
+if __name__ == '__main__':
+    main()
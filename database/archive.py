@@ -0,0 +1,254 @@
+import os
+import io
+import json
+import gzip
+import base64
+import time
+import queue
+import atexit
+import socket
+import threading
+import traceback
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from database.s3 import s3
+from utils import fast_json
+from utils.logger import logger_1st
+
+
+ARCHIVE_BACKEND = os.environ.get('ARCHIVE_BACKEND', 's3')
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', 'tpd-archive')
+ARCHIVE_LOCAL_DIR = os.environ.get('ARCHIVE_LOCAL_DIR', 'archive')
+# parts that cannot be written to the backend are kept here instead of being dropped
+ARCHIVE_SPILL_DIR = os.environ.get('ARCHIVE_SPILL_DIR', 'archive-spill')
+ARCHIVE_PART_MAX_BYTES = int(os.environ.get('ARCHIVE_PART_MAX_BYTES', 64 * 1024 * 1024))  # uncompressed
+ARCHIVE_PART_MAX_SECONDS = float(os.environ.get('ARCHIVE_PART_MAX_SECONDS', 300))
+ARCHIVE_QUEUE_SIZE = int(os.environ.get('ARCHIVE_QUEUE_SIZE', 10_000))
+ARCHIVE_PART_SUFFIX = '.ndjson.gz'
+
+
+class S3Backend:
+    def __init__(self, bucket_name: str = ARCHIVE_BUCKET):
+        self.bucket_name = bucket_name
+
+    def write(self, key: str, data: bytes):
+        s3.put_object(Bucket=self.bucket_name, Key=key, Body=data, ContentType='application/x-ndjson', ContentEncoding='gzip')
+
+    def list(self, prefix: str) -> list[str]:
+        keys = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+    def read(self, key: str) -> bytes:
+        return s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+
+    def __repr__(self):
+        return f's3://{self.bucket_name}'
+
+
+class LocalBackend:
+    def __init__(self, root: str = ARCHIVE_LOCAL_DIR):
+        self.root = root
+
+    def write(self, key: str, data: bytes):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def list(self, prefix: str) -> list[str]:
+        # prefixes are s3-style, '1st/processed/20250607' matches files in 1st/processed starting with 20250607
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        keys = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    keys.append(key)
+        return keys
+
+    def read(self, key: str) -> bytes:
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    def __repr__(self):
+        return self.root
+
+
+def get_backend(name: str = ARCHIVE_BACKEND):
+    if name == 's3':
+        return S3Backend()
+    if name == 'local':
+        return LocalBackend()
+    raise ValueError(f'unknown archive backend: {name}')
+
+
+def to_ndjson_line(data: bytes | str) -> bytes:
+    # raw newlines can only be whitespace in valid json (inside strings they are escaped), so they are safe to drop
+    if isinstance(data, str):
+        data = data.encode()
+    return data.replace(b'\r', b'').replace(b'\n', b' ')
+
+
+def make_record(source: str, data: bytes | str | None = None, verified: bool = True, **fields) -> bytes:
+    '''
+    one ndjson line: {"archived_at": ..., "source": ..., <fields>, "data": <data>}.
+    data known to be valid json (verified) is embedded as-is, so a received json body is archived without being
+    parsed and dumped again. unverified data is parsed first and, if it is not json, stored as "data_base64" instead,
+    spliced in it would break the line and every other record of the part.
+    '''
+    header = {'archived_at': datetime.now(timezone.utc).isoformat(), 'source': source, **fields}
+    line = json.dumps(header, default=str, separators=(',', ':')).encode()
+    if data is None:
+        return line
+    if isinstance(data, str):
+        data = data.encode()
+    if not verified:
+        try:
+            fast_json.loads(data)
+        except Exception:
+            return line[:-1] + b',"data_base64":"' + base64.b64encode(data) + b'"}'
+    return line[:-1] + b',"data":' + to_ndjson_line(data) + b'}'
+
+
+class ArchivePart:
+    def __init__(self, partition: str):
+        self.partition = partition
+        self.opened_at = time.monotonic()
+        self.buffer = io.BytesIO()
+        self.file = gzip.GzipFile(fileobj=self.buffer, mode='wb', compresslevel=6)
+        self.records = 0
+        self.size = 0
+        self.futures = []
+
+    def append(self, line: bytes, future: Future):
+        self.file.write(line)
+        self.file.write(b'\n')
+        self.records += 1
+        self.size += len(line) + 1
+        self.futures.append(future)
+
+    def close(self) -> bytes:
+        self.file.close()
+        return self.buffer.getvalue()
+
+    def resolve(self, key: str | None = None, error: Exception | None = None):
+        for future in self.futures:
+            if error is None:
+                future.set_result(key)
+            else:
+                future.set_exception(error)
+
+
+class Archiver:
+    '''
+    background archiver: append() only queues a record, a single thread gzips records into one rolling ndjson part
+    per partition and writes a part out once it reaches max_part_bytes or max_part_seconds, and on stop().
+    append() returns a future that is resolved with the part's key once the part holding the record was written
+    (to the backend or the spill directory), or fails if the record was lost.
+    partitions are '<subdir>/dt=<yyyy-mm-dd>', e.g. 1st/processed/dt=2025-06-07.
+    '''
+
+    def __init__(self, backend=None, max_part_bytes: int = ARCHIVE_PART_MAX_BYTES, max_part_seconds: float = ARCHIVE_PART_MAX_SECONDS, queue_size: int = ARCHIVE_QUEUE_SIZE):
+        self.backend = backend or get_backend()
+        self.spill_backend = LocalBackend(ARCHIVE_SPILL_DIR)
+        self.max_part_bytes = max_part_bytes
+        self.max_part_seconds = max_part_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._parts = {}
+        self._sequence = 0
+        self._writer_id = f'{socket.gethostname()}-{os.getpid()}'
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = object()
+        atexit.register(self.stop)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='archiver', daemon=True)
+                self._thread.start()
+        return self
+
+    def append(self, s3_subdir: str, line: bytes) -> Future:
+        '''
+        queue one ndjson line (see make_record) for s3_subdir. blocks only if the archiver is queue_size records behind.
+        '''
+        if self._thread is None:
+            self.start()
+        partition = f'{s3_subdir}/dt={datetime.now(timezone.utc).date().isoformat()}'
+        future = Future()
+        self._queue.put((partition, line, future))
+        return future
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(self._stopped)
+        thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is self._stopped:
+                self.flush()
+                return
+            try:
+                if item is not None:
+                    self._append(*item)
+                self._roll_over()
+            except Exception as e:
+                logger_1st.error(f'Archiver._run(): {e}')
+                logger_1st.error(traceback.format_exc())
+
+    def _append(self, partition: str, line: bytes, future: Future):
+        try:
+            part = self._parts.get(partition)
+            if part is None:
+                part = self._parts[partition] = ArchivePart(partition)
+            part.append(line, future)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+    def _roll_over(self):
+        now = time.monotonic()
+        for partition, part in list(self._parts.items()):
+            if part.size >= self.max_part_bytes or now - part.opened_at >= self.max_part_seconds:
+                self._write_part(self._parts.pop(partition))
+
+    def flush(self):
+        for partition in list(self._parts):
+            self._write_part(self._parts.pop(partition))
+
+    def _write_part(self, part: ArchivePart):
+        self._sequence += 1
+        current_time = datetime.now(timezone.utc)
+        key = f'{part.partition}/{current_time.strftime("%Y%m%d-%H%M%S")}-{self._writer_id}-{self._sequence:06d}{ARCHIVE_PART_SUFFIX}'
+        try:
+            data = part.close()
+            try:
+                self.backend.write(key, data)
+                logger_1st.info(f'archived: {key} | records: {part.records}')
+            except Exception as e:
+                logger_1st.error(f'Archiver._write_part(): {key}: {e}')
+                logger_1st.error(traceback.format_exc())
+                self.spill_backend.write(key, data)
+                logger_1st.warning(f'Archiver._write_part(): {key} kept in {self.spill_backend}')
+        except Exception as e:
+            logger_1st.error(f'Archiver._write_part(): {key} lost, {part.records} records')
+            logger_1st.error(traceback.format_exc())
+            part.resolve(error=e)
+            return
+        part.resolve(key)
+
+
+archiver = Archiver()
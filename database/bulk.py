@@ -0,0 +1,169 @@
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Session
+from database.general import FirstFixture, FirstRace, FirstEntry
+
+
+BULK_CHUNK_SIZE = 500
+
+
+def chunked(items: list, size: int = BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_primary_key_column(model):
+    return model.__mapper__.primary_key[0]
+
+
+def dedupe_rows(model, rows: list[dict]) -> list[dict]:
+    '''
+    keep the last row seen for each primary key, a key repeated inside one multi-row statement would be counted twice.
+    '''
+    pk_name = get_primary_key_column(model).name
+    return list({row[pk_name]: row for row in rows}.values())
+
+
+def get_existing_keys(session: Session, model, keys) -> set:
+    '''
+    return the subset of keys already present in model's table, looked up by primary key in chunks.
+    '''
+    pk = get_primary_key_column(model)
+    existing_keys = set()
+    for chunk in chunked(list(keys)):
+        existing_keys.update(session.execute(select(pk).where(pk.in_(chunk))).scalars())
+    return existing_keys
+
+
+def on_duplicate_key_skip(stmt, model):
+    '''
+    ON DUPLICATE KEY UPDATE <pk> = <pk>: rows whose key already exists are left as they are.
+    unlike INSERT IGNORE, data errors (truncation, NOT NULL, bad types) still raise instead of storing a mangled row.
+    '''
+    pk = get_primary_key_column(model)
+    return stmt.on_duplicate_key_update({pk.name: pk})
+
+
+def bulk_upsert(session: Session, model, rows: list[dict], columns: list[str], overwrite: bool = False) -> dict:
+    '''
+    write rows into model's table with one multi-row INSERT ... ON DUPLICATE KEY UPDATE per chunk.
+    only `columns` are written, existing rows are left untouched unless overwrite is True (see on_duplicate_key_skip).
+
+    counts rely on the CLIENT.FOUND_ROWS flag that SQLAlchemy always sets for MySQL/MariaDB:
+    each inserted row reports 1, each updated row 2 and each unchanged row 1. inserted is taken from a key lookup
+    just before the write, so the counts are only exact without concurrent writers to the same keys.
+    '''
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    rows = dedupe_rows(model, rows)
+    if not rows:
+        return counts
+
+    pk_name = get_primary_key_column(model).name
+    update_columns = [column for column in columns if column != pk_name]
+    for chunk in chunked(rows):
+        values = [{column: row.get(column) for column in columns} for row in chunk]
+        stmt = insert(model.__table__).values(values)
+        existing_keys = get_existing_keys(session, model, [row[pk_name] for row in values])
+        if overwrite:
+            stmt = stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in update_columns})
+            rowcount = session.execute(stmt).rowcount
+            updated = rowcount - len(values)
+            counts['inserted'] += len(values) - len(existing_keys)
+            counts['updated'] += updated
+            counts['unchanged'] += len(existing_keys) - updated
+        else:
+            # with FOUND_ROWS a skipped duplicate reports 1 like an insert, so the counts come from the existing keys
+            session.execute(on_duplicate_key_skip(stmt, model))
+            counts['inserted'] += len(values) - len(existing_keys)
+            counts['unchanged'] += len(existing_keys)
+    return counts
+
+
+def split_fixture_rows(fixtures: list[dict]) -> tuple[list[dict], list[dict], list[dict]]:
+    '''
+    flatten processed fixtures into fixture, race and entry rows.
+    '''
+    fixture_rows = []
+    race_rows = []
+    entry_rows = []
+    for fixture in fixtures:
+        fixture_rows.append(fixture)
+        for race in fixture.get('race_data', []):
+            race_rows.append(race)
+            entry_rows.extend(race.get('entry_data', []))
+    return fixture_rows, race_rows, entry_rows
+
+
+def bulk_upsert_fixtures(session: Session, fixtures: list[dict], fixture_columns: list[str], race_columns: list[str], entry_columns: list[str], overwrite: bool = False) -> dict:
+    '''
+    flatten processed fixtures into fixture, race and entry rows and upsert each table with bulk_upsert().
+    '''
+    fixture_rows, race_rows, entry_rows = split_fixture_rows(fixtures)
+    return {
+        'fixture': bulk_upsert(session, FirstFixture, fixture_rows, fixture_columns, overwrite=overwrite),
+        'race': bulk_upsert(session, FirstRace, race_rows, race_columns, overwrite=overwrite),
+        'entry': bulk_upsert(session, FirstEntry, entry_rows, entry_columns, overwrite=overwrite),
+    }
+
+
+def format_upsert_counts(counts: dict) -> str:
+    return ' | '.join(
+        f'{table}: inserted {c["inserted"]}, updated {c["updated"]}, unchanged {c["unchanged"]}'
+        + (f', skipped {c["skipped"]}' if 'skipped' in c else '')
+        for table, c in counts.items()
+    )
+
+
+def bulk_insert_new(session: Session, model, rows: dict) -> dict:
+    '''
+    insert the rows of a {primary_key: row} dict that are not in model's table yet.
+    only the candidate keys are looked up (chunked IN on the primary key), so the cost does not grow with the table,
+    and duplicates are skipped by the insert itself (on_duplicate_key_skip), so a row written concurrently
+    by another worker is not an error.
+    the counts are an estimate: with FOUND_ROWS a skipped duplicate reports the same rowcount as an insert,
+    so inserted is every row missing at the lookup, including rows another worker wrote in the meantime.
+    '''
+    counts = {'inserted': 0, 'skipped': 0}
+    if not rows:
+        return counts
+
+    existing_keys = get_existing_keys(session, model, rows.keys())
+    new_rows = [row for key, row in rows.items() if key not in existing_keys]
+    counts['skipped'] += len(existing_keys)
+    if not new_rows:
+        return counts
+
+    columns = [column.name for column in model.__table__.columns if any(column.name in row for row in new_rows)]
+    for chunk in chunked(new_rows):
+        values = [{column: row.get(column) for column in columns} for row in chunk]
+        session.execute(on_duplicate_key_skip(insert(model.__table__).values(values), model))
+        counts['inserted'] += len(values)
+    return counts
+
+
+def bulk_get_or_create_ids(session: Session, model, key_columns: list[str], rows: dict) -> dict:
+    '''
+    resolve a {key tuple: row to insert} dict against an auto-increment table whose natural key is key_columns.
+    existing keys are found with one chunked tuple IN select, the missing rows are inserted with one multi-row
+    insert that skips duplicates (on_duplicate_key_skip) and selected again. returns {key tuple: id}.
+    '''
+    ids = {}
+    if not rows:
+        return ids
+
+    pk = get_primary_key_column(model)
+    columns = [model.__table__.c[column] for column in key_columns]
+
+    def select_ids(keys: list):
+        for chunk in chunked(keys):
+            for row in session.execute(select(pk, *columns).where(tuple_(*columns).in_(chunk))):
+                ids[tuple(row[1:])] = row[0]
+
+    select_ids(list(rows))
+    missing_keys = [key for key in rows if key not in ids]
+    if missing_keys:
+        # duplicates on the unique natural key are skipped, rows created meanwhile by another worker are picked up by the re-select
+        for chunk in chunked(missing_keys):
+            session.execute(on_duplicate_key_skip(insert(model.__table__).values([rows[key] for key in chunk]), model))
+        select_ids(missing_keys)
+    return ids
@@ -0,0 +1,66 @@
+import os
+import json
+from datetime import datetime, timezone
+from database.s3 import s3
+from utils.compression import get_json_file_extension
+from utils.logger import logger_1st
+
+
+# bodies above the threshold are stored in s3 (or CLAIM_CHECK_DIR locally) and only a pointer goes through sqs,
+# the stored object doubles as the archive copy of the push
+CLAIM_CHECK_THRESHOLD = int(os.environ.get('CLAIM_CHECK_THRESHOLD', 200 * 1024))
+CLAIM_CHECK_BUCKET = os.environ.get('CLAIM_CHECK_BUCKET', 'tpd-archive')
+CLAIM_CHECK_PREFIX = os.environ.get('CLAIM_CHECK_PREFIX', '1st/claim-check')
+CLAIM_CHECK_DIR = os.environ.get('CLAIM_CHECK_DIR')
+CLAIM_CHECK_ATTRIBUTE = 'claim_check'
+
+
+def needs_claim_check(body: bytes) -> bool:
+    return len(body) > CLAIM_CHECK_THRESHOLD
+
+
+def store_payload(body: bytes, file_name: str = None, content_encoding: str | None = None) -> dict:
+    '''
+    store a large body (optionally compressed, see content_encoding) and return the pointer to send instead of it.
+    '''
+    if not file_name:
+        current_time = datetime.now(timezone.utc)
+        file_name = f'{current_time.strftime("%Y%m%d-%H%M%S")}-{int(current_time.microsecond / 1000):03d}-{os.urandom(4).hex()}{get_json_file_extension(content_encoding)}'
+    if CLAIM_CHECK_DIR:
+        path = os.path.join(CLAIM_CHECK_DIR, file_name)
+        os.makedirs(CLAIM_CHECK_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        pointer = {'path': path}
+    else:
+        key = f'{CLAIM_CHECK_PREFIX}/{file_name}'
+        extra_args = {'ContentType': 'application/json', 'ContentEncoding': content_encoding} if content_encoding else {}
+        s3.put_object(Bucket=CLAIM_CHECK_BUCKET, Key=key, Body=body, **extra_args)
+        pointer = {'bucket': CLAIM_CHECK_BUCKET, 'key': key}
+    if content_encoding:
+        pointer['content_encoding'] = content_encoding
+    logger_1st.info(f'claim check stored: {pointer}, bytes: {len(body)}')
+    return pointer
+
+
+def load_payload(pointer: dict) -> bytes:
+    if 'path' in pointer:
+        with open(pointer['path'], 'rb') as f:
+            return f.read()
+    return s3.get_object(Bucket=pointer['bucket'], Key=pointer['key'])['Body'].read()
+
+
+def make_pointer_message(pointer: dict) -> tuple[str, dict]:
+    '''
+    sqs body and message attributes for a claim-check pointer.
+    '''
+    attributes = {CLAIM_CHECK_ATTRIBUTE: {'DataType': 'String', 'StringValue': 'true'}}
+    return json.dumps({CLAIM_CHECK_ATTRIBUTE: pointer}), attributes
+
+
+def is_claim_check(message: dict) -> bool:
+    return CLAIM_CHECK_ATTRIBUTE in message.get('MessageAttributes', {})
+
+
+def get_pointer(message: dict) -> dict:
+    return json.loads(message['Body'])[CLAIM_CHECK_ATTRIBUTE]
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import traceback
+from utils.cache import BoundedCache
+from utils.logger import logger_1st
+
+
+FINGERPRINT_STORE_SIZE = int(os.environ.get('FINGERPRINT_STORE_SIZE', 500_000))
+# a write made outside the push path (manual edits, another process) is masked for at most this long
+FINGERPRINT_TTL = float(os.environ.get('FINGERPRINT_TTL', 6 * 60 * 60))
+# unset keeps the fingerprints in memory only
+FINGERPRINT_STORE_PATH = os.environ.get('FINGERPRINT_STORE_PATH')
+
+
+def get_fingerprint(row: dict, columns: list[str]) -> str:
+    # repr() is stable for the str / int / float / Decimal / datetime values the processors produce
+    payload = repr(tuple(row.get(column) for column in columns)).encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+class FingerprintStore:
+    '''
+    fingerprint of the last written columns per (table, primary key), used to skip writes of rows that did not change.
+    fingerprints are only remembered after the transaction that wrote them committed.
+    '''
+
+    def __init__(self, name: str, max_size: int = FINGERPRINT_STORE_SIZE, ttl: float | None = FINGERPRINT_TTL, path: str | None = FINGERPRINT_STORE_PATH):
+        self.cache = BoundedCache(name, max_size=max_size, ttl=ttl)
+        self.path = path
+
+    def get_changed(self, table: str, rows: list[dict], columns: list[str], key_column: str) -> tuple[list[dict], dict, int]:
+        '''
+        rows whose fingerprint differs from the last written one, the fingerprints to remember once they are written
+        and the number of rows skipped. rows are deduplicated on key_column first (last one wins), like bulk_upsert().
+        '''
+        latest = {row[key_column]: row for row in rows}
+        changed = []
+        pending = {}
+        for key, row in latest.items():
+            fingerprint = get_fingerprint(row, columns)
+            if self.cache.get((table, key)) == fingerprint:
+                continue
+            changed.append(row)
+            pending[(table, key)] = fingerprint
+        return changed, pending, len(latest) - len(changed)
+
+    def remember(self, pending: dict):
+        for key, fingerprint in pending.items():
+            self.cache.set(key, fingerprint)
+
+    def forget(self, table: str, keys):
+        for key in keys:
+            self.cache.delete((table, key))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for table, key, fingerprint in json.load(f):
+                    self.cache.set((table, key), fingerprint)
+            logger_1st.info(f'FingerprintStore.load(): {len(self.cache)} fingerprints from {self.path}')
+        except Exception as e:
+            logger_1st.error(f'FingerprintStore.load(): {e}')
+            logger_1st.error(traceback.format_exc())
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump([[table, key, fingerprint] for (table, key), fingerprint in self.cache.items()], f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger_1st.error(f'FingerprintStore.save(): {e}')
+            logger_1st.error(traceback.format_exc())
+
+
+fixture_fingerprints = FingerprintStore('fixture_fingerprint')
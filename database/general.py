@@ -1,6 +1,6 @@
 import os
 import contextlib
-from sqlalchemy import create_engine, func, Column, DECIMAL, Date, DateTime, Float, ForeignKey, LargeBinary, String, Text, Time, text, JSON, Boolean, Numeric, Integer, Double
+from sqlalchemy import create_engine, func, Column, Index, UniqueConstraint, DECIMAL, Date, DateTime, Float, ForeignKey, LargeBinary, String, Text, Time, text, JSON, Boolean, Numeric, Integer, Double
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.dialects.mysql import BIGINT, DATETIME, INTEGER, LONGTEXT, MEDIUMBLOB, MEDIUMTEXT, SMALLINT, TEXT, TIME, TINYINT, VARCHAR
@@ -58,6 +58,7 @@ class MapCourse(Base):
 
 class MapMeeting(Base):
     __tablename__ = 'map_meeting'
+    __table_args__ = (UniqueConstraint('map_course_code', 'date', name='uq_map_meeting_course_date'),)
     id = Column(INTEGER(11), primary_key=True)
     gmax_estimated = Column(TINYINT(4), nullable=False, server_default=text('0'))
     gmax_meeting_sharecode = Column(String(20, 'utf8_bin'))
@@ -75,6 +76,7 @@ class MapMeeting(Base):
 
 class MapRace(Base):
     __tablename__ = 'map_race'
+    __table_args__ = (UniqueConstraint('map_meeting_id', 'race_number', name='uq_map_race_meeting_number'),)
     id = Column(INTEGER(11), primary_key=True)
     tracked = Column(TINYINT(1), nullable=False, server_default=text('1'))
     map_meeting_id = Column(INTEGER(11), ForeignKey('map_meeting.id'))
@@ -102,6 +104,7 @@ class MapRace(Base):
 
 class MapRunner(Base):
     __tablename__ = 'map_runner'
+    __table_args__ = (UniqueConstraint('map_race_id', 'runner_number', name='uq_map_runner_race_number'),)
     id = Column(INTEGER(11), primary_key=True)
     map_race_id = Column(INTEGER(11), ForeignKey('map_race.id'))
     gmax_runner_sharecode = Column(String(20, 'utf8_bin'))
@@ -267,6 +270,10 @@ class FirstEntry(Base):
 
 class FirstPriceHistory(Base):
     __tablename__ = 'first_price_history'
+    __table_args__ = (
+        Index('ix_first_price_history_entry_timestamp', 'entry_id', 'timestamp'),
+        Index('ix_first_price_history_created_at', 'created_at'),
+    )
     price_id = Column(VARCHAR(16), primary_key=True)
     entry_id = Column(VARCHAR(16))
     timestamp = Column(DateTime)
@@ -279,6 +286,10 @@ class FirstPriceHistory(Base):
 
 class FirstRaceStatusHistory(Base):
     __tablename__ = 'first_race_status_history'
+    __table_args__ = (
+        Index('ix_first_race_status_history_race_timestamp', 'race_id', 'timestamp'),
+        Index('ix_first_race_status_history_created_at', 'created_at'),
+    )
     race_status_id = Column(VARCHAR(16), primary_key=True)
     race_id = Column(VARCHAR(8))
     status = Column(VARCHAR(16))
@@ -333,3 +344,21 @@ class FirstOwner(Base):
     created_at = Column(DateTime, default=func.current_timestamp())
     updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
 
+
+class FirstHorsePending(Base):
+    __tablename__ = 'first_horse_pending'
+    __table_args__ = (Index('ix_first_horse_pending_status_next_attempt', 'status', 'next_attempt_at'),)
+    horse_id = Column(VARCHAR(8), primary_key=True)
+    status = Column(VARCHAR(16), nullable=False, server_default=text("'pending'"))
+    attempts = Column(Integer, nullable=False, server_default=text('0'))
+    next_attempt_at = Column(DateTime, server_default=func.current_timestamp())
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=func.current_timestamp())
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
+
+
+class FirstJobState(Base):
+    __tablename__ = 'first_job_state'
+    job = Column(VARCHAR(64), primary_key=True)
+    watermark = Column(DateTime)
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
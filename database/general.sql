@@ -197,3 +197,36 @@ CREATE TABLE first_owner (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
 
+
+-- natural keys for the tpd mapping tables, required by the atomic get-or-create in database/bulk.py.
+-- existing duplicate (map_course_code, date), (map_meeting_id, race_number) and (map_race_id, runner_number) rows must be merged first.
+ALTER TABLE map_meeting ADD UNIQUE KEY uq_map_meeting_course_date (map_course_code, date);
+ALTER TABLE map_race ADD UNIQUE KEY uq_map_race_meeting_number (map_meeting_id, race_number);
+ALTER TABLE map_runner ADD UNIQUE KEY uq_map_runner_race_number (map_race_id, runner_number);
+
+-- covering indexes for the per-entry / per-race MAX(timestamp) watermark lookups in process/watermark.py.
+CREATE INDEX ix_first_price_history_entry_timestamp ON first_price_history (entry_id, timestamp);
+CREATE INDEX ix_first_race_status_history_race_timestamp ON first_race_status_history (race_id, timestamp);
+
+-- incremental parquet export (database/parquet_export.py) picks up new history rows by created_at.
+CREATE INDEX ix_first_price_history_created_at ON first_price_history (created_at);
+CREATE INDEX ix_first_race_status_history_created_at ON first_race_status_history (created_at);
+
+-- horses waiting for enrichment from 1st's horse endpoint, see upload/horse.py.
+-- rows are deleted once the horse is in first_horse, status 'failed' rows are retried only after a manual reset to 'pending'.
+CREATE TABLE first_horse_pending (
+    horse_id VARCHAR(8) PRIMARY KEY,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    KEY ix_first_horse_pending_status_next_attempt (status, next_attempt_at)
+);
+
+CREATE TABLE first_job_state (
+    job VARCHAR(64) PRIMARY KEY,
+    watermark TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
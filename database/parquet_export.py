@@ -0,0 +1,236 @@
+'''
+incremental parquet export of the price and race status history for analysis.
+
+    python -m database.parquet_export [--root s3://bucket/prefix | local/dir] [--full]
+
+three hive-partitioned datasets (fixture_date=YYYY-MM-DD/track_id=...) are written under the root:
+    price_history        first_price_history rows plus their entry / race / fixture keys, appended on created_at
+    race_status_history  first_race_status_history rows plus their race / fixture keys, appended on created_at
+    entries              entry, race and fixture context, partitions of updated fixtures are rewritten
+
+join the history to entries on entry_id / race_id for results, prices at the off, etc.
+'''
+import os
+import json
+import uuid
+import argparse
+import traceback
+from datetime import datetime, timedelta, timezone
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from database.general import mariadb_engine
+from utils.logger import logger_1st
+
+
+PARQUET_EXPORT_ROOT = os.environ.get('PARQUET_EXPORT_ROOT', 'parquet')
+PARQUET_EXPORT_BATCH_ROWS = int(os.environ.get('PARQUET_EXPORT_BATCH_ROWS', 200_000))
+# rows created less than this many seconds ago are left for the next run, their transaction may not be visible yet
+PARQUET_EXPORT_LAG = int(os.environ.get('PARQUET_EXPORT_LAG', 300))
+PARTITION_COLUMNS = ['fixture_date', 'track_id']
+STATE_FILE = '_export_state.json'
+EPOCH = datetime(1970, 1, 1)
+
+
+PRICE_HISTORY_SCHEMA = pa.schema([
+    ('price_id', pa.string()),
+    ('entry_id', pa.string()),
+    ('timestamp', pa.timestamp('us')),
+    ('numerator', pa.string()),
+    ('denominator', pa.string()),
+    ('market', pa.string()),
+    ('created_at', pa.timestamp('us')),
+    ('race_id', pa.string()),
+    ('fixture_id', pa.string()),
+    ('fixture_date', pa.string()),
+    ('track_id', pa.string()),
+])
+RACE_STATUS_HISTORY_SCHEMA = pa.schema([
+    ('race_status_id', pa.string()),
+    ('race_id', pa.string()),
+    ('status', pa.string()),
+    ('timestamp', pa.timestamp('us')),
+    ('created_at', pa.timestamp('us')),
+    ('fixture_id', pa.string()),
+    ('fixture_date', pa.string()),
+    ('track_id', pa.string()),
+])
+ENTRIES_SCHEMA = pa.schema([
+    ('entry_id', pa.string()),
+    ('race_id', pa.string()),
+    ('fixture_id', pa.string()),
+    ('fixture_date', pa.string()),
+    ('track_id', pa.string()),
+    ('track_name', pa.string()),
+    ('race_number', pa.int32()),
+    ('race_name', pa.string()),
+    ('post_time', pa.timestamp('us')),
+    ('off_time', pa.timestamp('us')),
+    ('distance', pa.int32()),
+    ('distance_unit', pa.string()),
+    ('going', pa.string()),
+    ('surface_id', pa.string()),
+    ('racetype_id', pa.string()),
+    ('race_class', pa.string()),
+    ('runner_count', pa.int32()),
+    ('race_status', pa.string()),
+    ('program_number', pa.string()),
+    ('start_number', pa.string()),
+    ('horse_id', pa.string()),
+    ('jockey_id', pa.string()),
+    ('trainer_id', pa.string()),
+    ('owner_id', pa.string()),
+    ('entry_status', pa.string()),
+    ('weight', pa.int32()),
+    ('weight_unit', pa.string()),
+    ('starting_price_nominator', pa.string()),
+    ('starting_price_denominator', pa.string()),
+    ('fav_pos', pa.string()),
+    ('final_position', pa.int32()),
+    ('dead_heat', pa.string()),
+    ('disqualified', pa.bool_()),
+    ('tpd_meeting_id', pa.int64()),
+    ('tpd_race_id', pa.int64()),
+    ('tpd_runner_id', pa.int64()),
+])
+
+
+# history is picked up by created_at, which is indexed; fixture_date is rendered as the partition string
+PRICE_HISTORY_SQL = text('''
+    SELECT p.price_id, p.entry_id, p.timestamp, p.numerator, p.denominator, p.market, p.created_at,
+           e.race_id, r.fixture_id, DATE_FORMAT(f.fixture_date, '%Y-%m-%d') AS fixture_date, f.track_id
+    FROM first_price_history p
+    LEFT JOIN first_entry e ON e.entry_id = p.entry_id
+    LEFT JOIN first_race r ON r.race_id = e.race_id
+    LEFT JOIN first_fixture f ON f.fixture_id = r.fixture_id
+    WHERE p.created_at > :since AND p.created_at <= :until
+''')
+RACE_STATUS_HISTORY_SQL = text('''
+    SELECT s.race_status_id, s.race_id, s.status, s.timestamp, s.created_at,
+           r.fixture_id, DATE_FORMAT(f.fixture_date, '%Y-%m-%d') AS fixture_date, f.track_id
+    FROM first_race_status_history s
+    LEFT JOIN first_race r ON r.race_id = s.race_id
+    LEFT JOIN first_fixture f ON f.fixture_id = r.fixture_id
+    WHERE s.created_at > :since AND s.created_at <= :until
+''')
+UPDATED_PARTITIONS_SQL = text('''
+    SELECT DISTINCT DATE_FORMAT(f.fixture_date, '%Y-%m-%d') AS fixture_date, f.track_id
+    FROM first_fixture f
+    JOIN first_race r ON r.fixture_id = f.fixture_id
+    JOIN first_entry e ON e.race_id = r.race_id
+    WHERE (e.updated_at > :since OR r.updated_at > :since OR f.updated_at > :since)
+      AND f.fixture_date IS NOT NULL AND f.track_id IS NOT NULL
+''')
+ENTRIES_SQL = text('''
+    SELECT e.entry_id, e.race_id, r.fixture_id, DATE_FORMAT(f.fixture_date, '%Y-%m-%d') AS fixture_date, f.track_id, t.track_name,
+           r.race_number, r.race_name, r.post_time, r.off_time, r.distance, r.distance_unit, r.going, r.surface_id,
+           r.racetype_id, r.race_class, r.runner_count, r.race_status,
+           e.program_number, e.start_number, e.horse_id, e.jockey_id, e.trainer_id, e.owner_id, e.entry_status,
+           e.weight, e.weight_unit, e.starting_price_nominator, e.starting_price_denominator, e.fav_pos,
+           e.final_position, e.dead_heat, e.disqualified,
+           f.tpd_meeting_id, r.tpd_race_id, e.tpd_runner_id
+    FROM first_fixture f
+    JOIN first_race r ON r.fixture_id = f.fixture_id
+    JOIN first_entry e ON e.race_id = r.race_id
+    LEFT JOIN first_track t ON t.track_id = f.track_id
+    WHERE f.fixture_date = :fixture_date AND f.track_id = :track_id
+''')
+
+
+def get_filesystem(root: str) -> tuple[pafs.FileSystem, str]:
+    if '://' in root:
+        return pafs.FileSystem.from_uri(root)
+    os.makedirs(root, exist_ok=True)
+    return pafs.LocalFileSystem(), os.path.abspath(root)
+
+
+def load_state(filesystem: pafs.FileSystem, root: str) -> dict:
+    path = f'{root}/{STATE_FILE}'
+    if filesystem.get_file_info(path).type == pafs.FileType.NotFound:
+        return {}
+    with filesystem.open_input_stream(path) as f:
+        return json.loads(f.read())
+
+
+def save_state(filesystem: pafs.FileSystem, root: str, state: dict):
+    with filesystem.open_output_stream(f'{root}/{STATE_FILE}') as f:
+        f.write(json.dumps(state, indent=2).encode())
+
+
+def write_rows(rows: list[dict], schema: pa.Schema, filesystem: pafs.FileSystem, path: str, basename: str, replace_partitions: bool = False) -> int:
+    if not rows:
+        return 0
+    pq.write_to_dataset(
+        pa.Table.from_pylist(rows, schema=schema),
+        root_path=path,
+        partition_cols=PARTITION_COLUMNS,
+        filesystem=filesystem,
+        basename_template=f'{basename}-{{i}}.parquet',
+        existing_data_behavior='delete_matching' if replace_partitions else 'overwrite_or_ignore',
+    )
+    return len(rows)
+
+
+def export_history(connection, name: str, sql, schema: pa.Schema, filesystem: pafs.FileSystem, root: str, since: datetime, until: datetime, run_id: str) -> int:
+    '''
+    append the rows created in (since, until] to the dataset, one set of part files per batch.
+    '''
+    exported = 0
+    result = connection.execution_options(stream_results=True).execute(sql, {'since': since, 'until': until})
+    for batch_number, batch in enumerate(result.mappings().partitions(PARQUET_EXPORT_BATCH_ROWS)):
+        exported += write_rows([dict(row) for row in batch], schema, filesystem, f'{root}/{name}', f'{run_id}-{batch_number:04d}')
+    return exported
+
+
+def export_entries(connection, filesystem: pafs.FileSystem, root: str, since: datetime, run_id: str) -> int:
+    '''
+    rewrite the entries partition of every (fixture_date, track_id) with an entry, race or fixture updated after since.
+    '''
+    exported = 0
+    partitions = connection.execute(UPDATED_PARTITIONS_SQL, {'since': since}).mappings().all()
+    for partition in partitions:
+        rows = [dict(row) for row in connection.execute(ENTRIES_SQL, dict(partition)).mappings()]
+        exported += write_rows(rows, ENTRIES_SCHEMA, filesystem, f'{root}/entries', run_id, replace_partitions=True)
+    return exported
+
+
+def export_to_parquet(root: str = PARQUET_EXPORT_ROOT, full: bool = False) -> dict | None:
+    '''
+    export everything created (history) or updated (entries) since the previous run, see the module docstring.
+    '''
+    try:
+        filesystem, root_path = get_filesystem(root)
+        state = {} if full else load_state(filesystem, root_path)
+        run_id = f'{datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        counts = {}
+        with mariadb_engine.connect() as connection:
+            until = connection.execute(text('SELECT NOW()')).scalar() - timedelta(seconds=PARQUET_EXPORT_LAG)
+            for name, sql, schema in [
+                ('price_history', PRICE_HISTORY_SQL, PRICE_HISTORY_SCHEMA),
+                ('race_status_history', RACE_STATUS_HISTORY_SQL, RACE_STATUS_HISTORY_SCHEMA),
+            ]:
+                since = datetime.fromisoformat(state[name]) if name in state else EPOCH
+                counts[name] = export_history(connection, name, sql, schema, filesystem, root_path, since, until, run_id)
+                state[name] = until.isoformat()
+                save_state(filesystem, root_path, state)
+
+            since = datetime.fromisoformat(state['entries']) if 'entries' in state else EPOCH
+            counts['entries'] = export_entries(connection, filesystem, root_path, since, run_id)
+            state['entries'] = until.isoformat()
+            save_state(filesystem, root_path, state)
+
+        logger_1st.info(f'export_to_parquet(): {root} | {counts}')
+        return counts
+    except Exception as e:
+        logger_1st.error(f'export_to_parquet(): {e}')
+        logger_1st.error(traceback.format_exc())
+        return None
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--root', default=PARQUET_EXPORT_ROOT)
+    arg_parser.add_argument('--full', action='store_true', help='ignore the saved state and export everything, into an empty root')
+    args = arg_parser.parse_args()
+    export_to_parquet(args.root, full=args.full)
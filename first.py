@@ -1,25 +1,131 @@
 import requests
+import asyncio
 import json
 import time
 import os
+import random
+import threading
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from datetime import date, datetime
 from dateutil.parser import parse
 from utils.logger import logger_1st
+from utils.http_cache import ResponseCache
+from utils import fast_json
 import traceback
 
 
-class FirstAPI:
+FIRST_API_TIMEOUT = float(os.getenv("FIRST_API_TIMEOUT", 30))
+FIRST_API_MAX_RETRIES = int(os.getenv("FIRST_API_MAX_RETRIES", 4))
+FIRST_API_BACKOFF_BASE = float(os.getenv("FIRST_API_BACKOFF_BASE", 1))
+FIRST_API_BACKOFF_MAX = float(os.getenv("FIRST_API_BACKOFF_MAX", 60))
+FIRST_API_RETRY_AFTER_MAX = float(os.getenv("FIRST_API_RETRY_AFTER_MAX", 300))
+FIRST_API_POOL_SIZE = int(os.getenv("FIRST_API_POOL_SIZE", 16))
+FIRST_API_CONCURRENCY = int(os.getenv("FIRST_API_CONCURRENCY", 8))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+TOKEN_REFRESH_MARGIN = 60  # seconds before expiry
+# seconds a cached response is served without asking 1st, 0 always revalidates (conditional GET + content hash)
+TRACKS_CACHE_TTL = float(os.getenv("FIRST_API_TRACKS_CACHE_TTL", 24 * 60 * 60))
+HORSES_CACHE_TTL = float(os.getenv("FIRST_API_HORSES_CACHE_TTL", 7 * 24 * 60 * 60))
+FOFIXTURES_CACHE_TTL = float(os.getenv("FIRST_API_FOFIXTURES_CACHE_TTL", 0))
+
+
+class EndpointStats:
+    """per-endpoint request, retry, error and latency counters, shared by every FirstAPI instance."""
+
     def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"requests": 0, "retries": 0, "errors": 0, "cache_hits": 0, "not_modified": 0, "latency_total": 0.0, "latency_max": 0.0})
+
+    def record(self, endpoint: str, latency: float = None, retry: bool = False, error: bool = False, cache_hit: bool = False, not_modified: bool = False):
+        with self._lock:
+            stats = self._stats[endpoint]
+            if latency is not None:
+                stats["requests"] += 1
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+            if retry:
+                stats["retries"] += 1
+            if error:
+                stats["errors"] += 1
+            if cache_hit:
+                stats["cache_hits"] += 1
+            if not_modified:
+                stats["not_modified"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    "requests": stats["requests"],
+                    "retries": stats["retries"],
+                    "errors": stats["errors"],
+                    "cache_hits": stats["cache_hits"],
+                    "not_modified": stats["not_modified"],
+                    "latency_avg": round(stats["latency_total"] / stats["requests"], 3) if stats["requests"] else None,
+                    "latency_max": round(stats["latency_max"], 3),
+                }
+                for endpoint, stats in self._stats.items()
+            }
+
+
+api_stats = EndpointStats()
+
+
+def get_endpoint(url: str) -> str:
+    # https://api.gws-eg.com/data/fofixtures/2025-06-07 -> data/fofixtures
+    parts = url.split("://", 1)[-1].split("/")
+    return "/".join(parts[1:3])
+
+
+def get_retry_after(response) -> float | None:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), FIRST_API_RETRY_AFTER_MAX)
+
+
+def get_backoff(attempt: int) -> float:
+    # full jitter, so clients retrying after the same failure spread out
+    return random.uniform(0, min(FIRST_API_BACKOFF_MAX, FIRST_API_BACKOFF_BASE * 2 ** attempt))
+
+
+def log_api_stats():
+    logger_1st.info(f"FirstAPI stats: {api_stats.snapshot()}")
+
+
+def get_cache_key(url: str, params: dict = None) -> str:
+    return f"{url}?{urlencode(sorted(params.items()))}" if params else url
+
+
+class FirstAPI:
+    def __init__(self, cache: ResponseCache = None):
+        self.cache = cache
         self.username = os.getenv("FIRST_USERNAME")
         self.password = os.getenv("FIRST_PASSWORD")
         self.token = None
         self.expire = None
+        self._auth_lock = threading.Lock()
+        # one keep-alive connection pool per client, safe to share between threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=FIRST_API_POOL_SIZE, pool_maxsize=FIRST_API_POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def authenticate(self):
         auth_url = "https://api.gws-eg.com/client/session/login"
         auth_headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
         auth_payload = {"username": self.username, "password": self.password}
-        response = requests.post(auth_url, data=json.dumps(auth_payload), headers=auth_headers, timeout=30)
+        response = self.session.post(auth_url, data=json.dumps(auth_payload), headers=auth_headers, timeout=FIRST_API_TIMEOUT)
         data = response.json()
 
         if response.status_code != 200:
@@ -39,30 +145,127 @@ class FirstAPI:
         return self.token
 
 
+    def token_expired(self):
+        return self.token is None or time.time() > self.expire - TOKEN_REFRESH_MARGIN
+
+
     def get_headers(self):
-        if self.token is None or time.time() > self.expire:
-            self.authenticate()
+        if self.token_expired():
+            # only the first caller re-authenticates, the others wait and reuse its token
+            with self._auth_lock:
+                if self.token_expired():
+                    self.authenticate()
         return {"accept": "application/json", "Authorization": f"Bearer {self.token}"}
 
 
-    def make_request(self, url, method="GET", params=None, data=None, retry=True):
-        headers = self.get_headers()
-        try:
-            response = requests.request(method, url, headers=headers, params=params, json=data, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            logger_1st.error(f"make_request(): {traceback.format_exc()}")
-            if retry:
-                time.sleep(10)
-                return self.make_request(url, method, params, data, retry=False)
+    def invalidate_token(self, token):
+        with self._auth_lock:
+            if self.token == token:
+                self.token = None
+
+
+    def make_request(self, url, method="GET", params=None, data=None, retry=True, cache_ttl=None, raw=False):
+        """
+        request with retries: connection errors, timeouts and RETRYABLE_STATUS_CODES are retried with jittered
+        exponential backoff (or the server's Retry-After), a 401 re-authenticates once. returns the json body or None.
+        with a cache and cache_ttl, GETs are served from the cache for cache_ttl seconds and revalidated after that
+        with If-None-Match / If-Modified-Since where 1st sent an ETag / Last-Modified.
+        with raw, the body is returned as bytes without being parsed.
+        """
+        endpoint = get_endpoint(url)
+        max_retries = FIRST_API_MAX_RETRIES if retry else 0
+        cache_key = get_cache_key(url, params)
+        use_cache = self.cache is not None and cache_ttl is not None and method == "GET"
+        cached = None
+        conditional_headers = {}
+        if use_cache:
+            cached = self.cache.get(cache_key)
+            body = self.cache.get_body(cache_key) if cached and time.time() - cached["stored_at"] < cache_ttl else None
+            if body is not None:
+                api_stats.record(endpoint, cache_hit=True)
+                return body if raw else fast_json.loads(body)
+            if cached and cached.get("etag"):
+                conditional_headers["If-None-Match"] = cached["etag"]
+            if cached and cached.get("last_modified"):
+                conditional_headers["If-Modified-Since"] = cached["last_modified"]
+
+        reauthenticated = False
+        attempt = 0
+        while True:
+            try:
+                headers = self.get_headers()
+                started_at = time.monotonic()
+                response = self.session.request(method, url, headers={**headers, **conditional_headers}, params=params, json=data, timeout=FIRST_API_TIMEOUT)
+                api_stats.record(endpoint, latency=time.monotonic() - started_at)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                reason, delay = repr(e), get_backoff(attempt)
+            except Exception:
+                logger_1st.error(f"make_request(): {traceback.format_exc()}")
+                api_stats.record(endpoint, error=True)
+                return None
             else:
+                if response.status_code == 304 and cached:
+                    body = self.cache.get_body(cache_key)
+                    if body is not None:
+                        self.cache.touch(cache_key, cached)
+                        api_stats.record(endpoint, not_modified=True)
+                        return body if raw else fast_json.loads(body)
+                    # the body is gone from the cache, fetch it again without validators
+                    cached, conditional_headers = None, {}
+                    continue
+                if response.status_code == 401 and not reauthenticated:
+                    reauthenticated = True
+                    self.invalidate_token(headers["Authorization"][len("Bearer "):])
+                    api_stats.record(endpoint, retry=True)
+                    continue
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    try:
+                        response.raise_for_status()
+                        result = response.content if raw else response.json()
+                        if use_cache:
+                            self.cache.put(cache_key, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                        return result
+                    except Exception:
+                        logger_1st.error(f"make_request(): {traceback.format_exc()}")
+                        api_stats.record(endpoint, error=True)
+                        return None
+                reason = f"{response.status_code} {response.reason}"
+                retry_after = get_retry_after(response)
+                delay = retry_after if retry_after is not None else get_backoff(attempt)
+
+            if attempt >= max_retries:
+                logger_1st.error(f"make_request(): {method} {url} failed after {attempt + 1} attempts: {reason}")
+                api_stats.record(endpoint, error=True)
                 return None
+            attempt += 1
+            api_stats.record(endpoint, retry=True)
+            logger_1st.warning(f"make_request(): {method} {url}: {reason}, retry {attempt}/{max_retries} in {delay:.1f} s")
+            time.sleep(delay)
+
+
+    def has_changed(self, url, params=None):
+        """
+        whether the last response for url differs from the one passed to mark_processed(), always true without a cache.
+        """
+        return self.cache is None or self.cache.has_changed(get_cache_key(url, params))
+
+
+    def mark_processed(self, url, params=None):
+        if self.cache is not None:
+            self.cache.mark_processed(get_cache_key(url, params))
+
+
+    def fofixtures_url(self, date: date = None, fixture_id: str = None):
+        if date:
+            return f"https://api.gws-eg.com/data/fofixtures/{date.strftime('%Y-%m-%d')}"
+        elif fixture_id:
+            return f"https://api.gws-eg.com/data/fofixtures/{fixture_id}"
+        return "https://api.gws-eg.com/data/fofixtures"
 
 
     def get_tracks(self):
         url = "https://api.gws-eg.com/data/tracks"
-        result = self.make_request(url)
+        result = self.make_request(url, cache_ttl=TRACKS_CACHE_TTL)
         if result:
             if "header" in result:
                 result.pop("header")
@@ -73,13 +276,8 @@ class FirstAPI:
 
 
     def get_fofixtures(self, date: date = None, fixture_id: str = None):
-        if date:
-            url = f"https://api.gws-eg.com/data/fofixtures/{date.strftime('%Y-%m-%d')}"
-        elif fixture_id:
-            url = f"https://api.gws-eg.com/data/fofixtures/{fixture_id}"
-        else:
-            url = "https://api.gws-eg.com/data/fofixtures"
-        result = self.make_request(url)
+        url = self.fofixtures_url(date=date, fixture_id=fixture_id)
+        result = self.make_request(url, cache_ttl=FOFIXTURES_CACHE_TTL)
         if result:
             if "header" in result:
                 result.pop("header")
@@ -89,6 +287,19 @@ class FirstAPI:
             return None
 
 
+    def get_fofixtures_body(self, date: date = None, fixture_id: str = None):
+        """
+        get_fofixtures() as the raw response body, for fast_json.iter_items(body, "fixtures.item"):
+        the fixtures can then be parsed one at a time instead of building the whole day as python objects.
+        """
+        url = self.fofixtures_url(date=date, fixture_id=fixture_id)
+        body = self.make_request(url, cache_ttl=FOFIXTURES_CACHE_TTL, raw=True)
+        if not body:
+            logger_1st.error(f"get_fofixtures_body(): {body}")
+            return None
+        return body
+
+
     def get_forace(self, fixture_id: str = None, race_nr: str = None, race_id: str = None):
         if fixture_id and race_nr:
             url = f"https://api.gws-eg.com/data/forace/{fixture_id}/{race_nr}"
@@ -118,7 +329,7 @@ class FirstAPI:
 
     def get_horses(self, horse_id: str):
         url = f"https://api.gws-eg.com/data/horses/{horse_id}"
-        result = self.make_request(url)
+        result = self.make_request(url, cache_ttl=HORSES_CACHE_TTL)
         if result:
             if "timestamp" in result:
                 result.pop("timestamp")
@@ -128,7 +339,42 @@ class FirstAPI:
             return None
 
 
+class AsyncFirstAPI:
+    """
+    asyncio front for FirstAPI with the same get_* methods. calls run the sync client in worker threads,
+    so authentication state, the connection pool, retries and stats are shared with it,
+    and at most `concurrency` requests are in flight at once.
+    """
+
+    def __init__(self, client: FirstAPI = None, concurrency: int = FIRST_API_CONCURRENCY):
+        self.client = client or FirstAPI()
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._loop = None
+
+    async def _call(self, method, *args, **kwargs):
+        # a semaphore belongs to the loop it is used on, e.g. each asyncio.run() of a scheduled job gets its own
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        async with self._semaphore:
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def get_tracks(self):
+        return await self._call(self.client.get_tracks)
+
+    async def get_fofixtures(self, date: date = None, fixture_id: str = None):
+        return await self._call(self.client.get_fofixtures, date=date, fixture_id=fixture_id)
 
+    async def get_fofixtures_body(self, date: date = None, fixture_id: str = None):
+        return await self._call(self.client.get_fofixtures_body, date=date, fixture_id=fixture_id)
 
+    async def get_forace(self, fixture_id: str = None, race_nr: str = None, race_id: str = None):
+        return await self._call(self.client.get_forace, fixture_id=fixture_id, race_nr=race_nr, race_id=race_id)
 
+    async def get_runners(self, runner_id: str):
+        return await self._call(self.client.get_runners, runner_id)
 
+    async def get_horses(self, horse_id: str):
+        return await self._call(self.client.get_horses, horse_id)
@@ -1,5 +1,5 @@
 import os
-import json
+import asyncio
 import boto3
 from typing import Dict, Any
 from fastapi import FastAPI, HTTPException, Depends, Header, Request
@@ -8,14 +8,29 @@ from fastapi.responses import JSONResponse
 import uvicorn
 import config
 from utils.logger import logger_1st
+from utils.sqs_publisher import SQSBatchPublisher
+from utils.fast_json import is_json_object
+from utils.sqs_message import build_queue_message
+from utils.compression import get_supported_encodings, detect_encoding, peek
 from functools import wraps
+from contextlib import asynccontextmanager
 
 
 # configs
-app = FastAPI(title="Data Collection API", version="1.0.0")
 security = HTTPBearer()
 api_key = os.getenv("TPD_API_KEY")
 sqs_client = boto3.client('sqs')
+sqs_publisher = SQSBatchPublisher(sqs_client, config.SQS_QUEUE_URL, linger_ms=float(os.getenv("SQS_PUBLISH_LINGER_MS", 5)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await sqs_publisher.start()
+    yield
+    await sqs_publisher.stop()
+
+
+app = FastAPI(title="Data Collection API", version="1.0.0", lifespan=lifespan)
 
 
 # Global exception handler for all unhandled exceptions
@@ -50,16 +65,36 @@ async def health_check():
 
 
 @app.post("/1st-data")
-async def receive_1st_data(data: Dict[str, Any]):
+async def receive_1st_data(request: Request):
     """Endpoint for 1st-data without authentication - IP whitelisted at ALB level"""
+    body = await request.body()
+    content_encoding = request.headers.get("content-encoding", "identity").strip().lower()
+    if content_encoding == "identity":
+        content_encoding = None
+    elif content_encoding not in get_supported_encodings():
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {content_encoding}")
+    if not is_valid_body(body, content_encoding):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
     try:
-        sqs_client.send_message(QueueUrl=config.SQS_QUEUE_URL, MessageBody=json.dumps(data))
+        # forward the raw (or still compressed) body as received, the processor parses it exactly once.
+        # compression and the claim check for oversized bodies run off the event loop
+        message_body, attributes = await asyncio.to_thread(build_queue_message, body, content_encoding)
+        await sqs_publisher.publish(message_body, attributes)
         return {"status": "success"}
     except Exception as e:
         logger_1st.error(f"Error in received 1st-data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+def is_valid_body(body: bytes, content_encoding: str | None) -> bool:
+    if content_encoding is None:
+        return is_json_object(body)
+    try:
+        return detect_encoding(body) == content_encoding and peek(body, content_encoding).lstrip().startswith(b"{")
+    except Exception:
+        return False
+
+
 @app.post("/{path:path}")
 async def receive_data(path: str, data: Dict[str, Any], api_key_verified: bool = Depends(verify_api_key)):
     """General endpoint for other paths with authentication"""
@@ -1,35 +1,46 @@
 import traceback
-from dateutil.parser import parse
+from utils.timestamps import parse_timestamp
 from process.helper import (
-    get_tpd_meeting_id, 
-    get_tpd_race_id, 
-    get_tpd_runner_id, 
+    resolve_tpd_ids,
     get_price_id, 
     get_race_status_id, 
 )
+from process.watermark import price_watermarks, race_status_watermarks, to_naive, NOTHING_STORED
 from utils.logger import logger_1st
 
-def process_fixture_from_push(data:dict)-> dict:
+def process_fixture_from_push(data:dict, use_watermarks:bool=True, resolve_ids:bool=True)-> dict:
     '''
     process fixture data received from push method, which 1st pushed to our endpoint.
+    with use_watermarks, price and race status ticks at or before the newest stored timestamp of their entry / race are skipped,
+    the returned *_watermarks are to be advanced once the history is committed.
+    without resolve_ids the tpd ids stay None and nothing is written to the map_* tables.
     '''
     race_status_history_dict = {}
     price_history_dict = {}
     fixture_data = []
+    new_price_watermarks = {}
+    new_race_status_watermarks = {}
     try:
         fixtures = data.get('fixtures', [])
+        stored_price_watermarks = {}
+        stored_race_status_watermarks = {}
+        if use_watermarks:
+            races = [race for fixture in fixtures for race in fixture.get('races', [])]
+            stored_race_status_watermarks = race_status_watermarks.get_many(
+                race.get('id') for race in races if race.get('statusHistory'))
+            stored_price_watermarks = price_watermarks.get_many(
+                entry.get('id') for race in races for entry in race.get('entries', []) if entry.get('showPrices'))
         for fixture in fixtures:
             fixture_header = fixture.get('header', {})
             fixture_id = fixture_header.get('id')
             fixture_date_string = fixture_header.get('date')
-            fixture_date = parse(fixture_date_string).date() if fixture_date_string else None
+            fixture_date = parse_timestamp(fixture_date_string).date() if fixture_date_string else None
             fixture_first_post_time_string = fixture_header.get('firstposttime')
-            fixture_first_post_time = parse(fixture_first_post_time_string) if fixture_first_post_time_string else None
+            fixture_first_post_time = parse_timestamp(fixture_first_post_time_string) if fixture_first_post_time_string else None
             fixture_race_count = fixture_header.get('racecount')
             fixture_temperature_fahrenheit = fixture_header.get('temperature', {}).get('fahrenheit')
             fixture_temperature_celsius = fixture_header.get('temperature', {}).get('celsius')
             track_id = fixture.get('track', {}).get('id')
-            tpd_meeting_id = get_tpd_meeting_id(track_id, fixture_date)
 
             race_data = []
             races = fixture.get('races', [])
@@ -39,11 +50,11 @@ def process_fixture_from_push(data:dict)-> dict:
                 race_number = int(race_number_string) if race_number_string else None
                 race_runner_count = race.get('runnercount')
                 race_post_time_string = race.get('posttime')
-                race_post_time = parse(race_post_time_string) if race_post_time_string else None
+                race_post_time = parse_timestamp(race_post_time_string) if race_post_time_string else None
                 race_estimated_post_time_string = race.get('estimatedPosttime')
-                race_estimated_post_time = parse(race_estimated_post_time_string) if race_estimated_post_time_string else None
+                race_estimated_post_time = parse_timestamp(race_estimated_post_time_string) if race_estimated_post_time_string else None
                 race_off_time_string = race.get('offTime')
-                race_off_time = parse(race_off_time_string) if race_off_time_string else None
+                race_off_time = parse_timestamp(race_off_time_string) if race_off_time_string else None
                 race_weather = race.get('weather')
                 race_going = race.get('going')
                 race_name = race.get('name')
@@ -53,13 +64,19 @@ def process_fixture_from_push(data:dict)-> dict:
                 race_overround = float(race_overround_string) if race_overround_string else None
                 race_overround_selection = race.get('overround_selection')
                 race_result = race.get('result')
-                tpd_race_id = get_tpd_race_id(tpd_meeting_id, race_number, race_post_time)
 
+                race_status_watermark = stored_race_status_watermarks.get(race_id, NOTHING_STORED)
                 race_status_histories = race.get('statusHistory', [])
                 for race_status_history in race_status_histories:
                     race_status_history_status = race_status_history.get('status')
                     race_status_history_timestamp_string = race_status_history.get('timestamp')
-                    race_status_history_timestamp = parse(race_status_history_timestamp_string) if race_status_history_timestamp_string else None
+                    race_status_history_timestamp = parse_timestamp(race_status_history_timestamp_string) if race_status_history_timestamp_string else None
+                    if race_status_history_timestamp:
+                        naive_timestamp = to_naive(race_status_history_timestamp)
+                        if naive_timestamp <= race_status_watermark:
+                            continue
+                        if naive_timestamp > new_race_status_watermarks.get(race_id, NOTHING_STORED):
+                            new_race_status_watermarks[race_id] = naive_timestamp
                     race_status_id = get_race_status_id(race_id, race_status_history_timestamp)
                     race_status_history_dict[race_status_id] = {
                         'race_status_id': race_status_id,
@@ -96,12 +113,18 @@ def process_fixture_from_push(data:dict)-> dict:
                     entry_final_dead_heat = entry.get('finalPosition', {}).get('deadHeat')
                     entry_final_disqualified = entry.get('finalPosition', {}).get('disqualified')
                     entry_final_amended_position = entry.get('finalPosition', {}).get('amendedPosition')
-                    tpd_runner_id = get_tpd_runner_id(tpd_race_id, program_number)
 
+                    price_watermark = stored_price_watermarks.get(entry_id, NOTHING_STORED)
                     show_prices = entry.get('showPrices', [])
                     for show_price in show_prices:
                         show_price_timestamp_string = show_price.get('timestamp')
-                        show_price_timestamp = parse(show_price_timestamp_string) if show_price_timestamp_string else None
+                        show_price_timestamp = parse_timestamp(show_price_timestamp_string) if show_price_timestamp_string else None
+                        if show_price_timestamp:
+                            naive_timestamp = to_naive(show_price_timestamp)
+                            if naive_timestamp <= price_watermark:
+                                continue
+                            if naive_timestamp > new_price_watermarks.get(entry_id, NOTHING_STORED):
+                                new_price_watermarks[entry_id] = naive_timestamp
                         show_price_numerator = show_price.get('numerator')
                         show_price_denominator = show_price.get('denominator')
                         show_price_market = show_price.get('market')
@@ -136,7 +159,7 @@ def process_fixture_from_push(data:dict)-> dict:
                         'dead_heat': entry_final_dead_heat,
                         'disqualified': entry_final_disqualified,
                         'amended_position': entry_final_amended_position,
-                        'tpd_runner_id': tpd_runner_id,
+                        'tpd_runner_id': None,
                     })
 
                 race_data.append({
@@ -155,7 +178,7 @@ def process_fixture_from_push(data:dict)-> dict:
                     'overround_selection': race_overround_selection,
                     'race_result': race_result,
                     'surface_id': track_surface_id,
-                    'tpd_race_id': tpd_race_id,
+                    'tpd_race_id': None,
                     'entry_data': entry_data,
                 })
 
@@ -167,10 +190,14 @@ def process_fixture_from_push(data:dict)-> dict:
                 'temperature_fahrenheit': fixture_temperature_fahrenheit,
                 'temperature_celsius': fixture_temperature_celsius,
                 'track_id': track_id,
-                'tpd_meeting_id': tpd_meeting_id,
+                'tpd_meeting_id': None,
                 'race_data': race_data,
             })
 
+        # tpd ids are resolved for the whole message at once, see resolve_tpd_ids()
+        if resolve_ids:
+            resolve_tpd_ids(fixture_data)
+
     except Exception as e:
         logger_1st.error(f'process_fixture_from_push(): {e}')
         logger_1st.error(traceback.format_exc())
@@ -179,5 +206,7 @@ def process_fixture_from_push(data:dict)-> dict:
         'fixtures': fixture_data,
         'race_status_history_dict': race_status_history_dict,
         'price_history_dict': price_history_dict,
+        'price_watermarks': new_price_watermarks,
+        'race_status_watermarks': new_race_status_watermarks,
     }
 
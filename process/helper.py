@@ -1,8 +1,27 @@
-from datetime import datetime, date
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
 import hashlib
 from utils.logger import logger_1st
+from utils.cache import BoundedCache
 import traceback
-from database.general import session_scope, FirstTrack, FirstFixture, FirstRace, FirstEntry, MapCourse, MapMeeting, MapRace, MapRunner
+from database.general import session_scope, FirstTrack, MapCourse, MapMeeting, MapRace, MapRunner
+from database.bulk import chunked, bulk_get_or_create_ids
+from process.watermark import JobWatermark
+
+
+# in-process caches for tpd mappings, only successful lookups are cached so unmapped keys keep reaching the database
+TPD_MAPPING_CACHE_SIZE = int(os.environ.get('TPD_MAPPING_CACHE_SIZE', 200_000))
+TPD_MAPPING_CACHE_TTL = float(os.environ.get('TPD_MAPPING_CACHE_TTL', 6 * 60 * 60))
+tpd_course_cache = BoundedCache('tpd_course', max_size=TPD_MAPPING_CACHE_SIZE, ttl=TPD_MAPPING_CACHE_TTL)    # track_id -> tpd_course_id
+tpd_meeting_cache = BoundedCache('tpd_meeting', max_size=TPD_MAPPING_CACHE_SIZE, ttl=TPD_MAPPING_CACHE_TTL)  # (tpd_course_id, date) -> map_meeting.id
+tpd_race_cache = BoundedCache('tpd_race', max_size=TPD_MAPPING_CACHE_SIZE, ttl=TPD_MAPPING_CACHE_TTL)        # (map_meeting.id, race_number) -> map_race.id
+tpd_runner_cache = BoundedCache('tpd_runner', max_size=TPD_MAPPING_CACHE_SIZE, ttl=TPD_MAPPING_CACHE_TTL)    # (map_race.id, program_number) -> map_runner.id
+
+
+def get_mapping_cache_stats() -> list[dict]:
+    return [cache.stats() for cache in (tpd_course_cache, tpd_meeting_cache, tpd_race_cache, tpd_runner_cache)]
 
 
 def get_price_id(entry_id: int, timestamp: datetime, sha_length: int = 16) -> str:
@@ -13,252 +32,223 @@ def get_race_status_id(race_id: int, timestamp: datetime, sha_length: int = 16)
     return hashlib.sha256(f'{race_id}{timestamp}'.encode()).hexdigest()[:sha_length]
 
 
-def manually_map_all_tpd_ids():
-    unmapped_fixture_ids = get_unmapped_fixture_ids()
-    logger_1st.info(f'unmapped_fixture_ids: {unmapped_fixture_ids}')
-    if unmapped_fixture_ids:
-        for fixture_id in unmapped_fixture_ids:
-            manually_map_tpd_meeting_id(fixture_id)
-
-    unmapped_race_ids = get_unmapped_race_ids()
-    logger_1st.info(f'unmapped_race_ids: {unmapped_race_ids}')
-    if unmapped_race_ids:
-        for race_id in unmapped_race_ids:
-            manually_map_tpd_race_id(race_id)
-
-    unmapped_entry_ids = get_unmapped_entry_ids()
-    logger_1st.info(f'unmapped_entry_ids: {unmapped_entry_ids}')
-    if unmapped_entry_ids:
-        for entry_id in unmapped_entry_ids:
-            manually_map_tpd_runner_id(entry_id)
-
-
-def get_unmapped_fixture_ids():
-    list_of_fixture_ids = []
-    with session_scope() as session:
-        unmapped_fixtures = session.query(FirstFixture).filter(FirstFixture.tpd_meeting_id == None).all()
-        if unmapped_fixtures:
-            for fixture in unmapped_fixtures:
-                list_of_fixture_ids.append(fixture.fixture_id)
-    return list_of_fixture_ids
-
-def get_unmapped_race_ids():
-    list_of_race_ids = []   
-    with session_scope() as session:
-        unmapped_races = session.query(FirstRace).filter(FirstRace.tpd_race_id == None).all()
-        if unmapped_races:
-            for race in unmapped_races:
-                list_of_race_ids.append(race.race_id)
-    return list_of_race_ids
-
-def get_unmapped_entry_ids():
-    list_of_entry_ids = []
-    with session_scope() as session:
-        unmapped_entries = session.query(FirstEntry).filter(FirstEntry.tpd_runner_id == None).all()
-        if unmapped_entries:
-            for entry in unmapped_entries:
-                list_of_entry_ids.append(entry.entry_id)
-    return list_of_entry_ids
-
-
-def manually_map_tpd_meeting_id(first_fixture_id :str) -> int:
-    try:
-        if first_fixture_id is None:
-            logger_1st.error(f'manually_map_tpd_meeting_id(): first_fixture_id is None')
-            return None
-        with session_scope() as session:
-            existing_fixture = session.query(FirstFixture).filter(FirstFixture.fixture_id == first_fixture_id).first()
-            if existing_fixture:
-                track_id = existing_fixture.track_id
-                fixture_date = existing_fixture.fixture_date
-            else:
-                logger_1st.error(f'manually_map_tpd_meeting_id(): no tpd_meeting_id for first_fixture_id: {first_fixture_id}')
-                return None
-
-        tpd_meeting_id = get_tpd_meeting_id(track_id = track_id, fixture_date = fixture_date)
-        if not tpd_meeting_id:
-            return None
-
-        with session_scope() as session:
-            existing_fixture = session.query(FirstFixture).filter(FirstFixture.fixture_id == first_fixture_id).first()
-            if existing_fixture:
-                existing_fixture.tpd_meeting_id = tpd_meeting_id
-                session.commit()
-                logger_1st.info(f'manually mapped tpd_meeting_id: {tpd_meeting_id} for first_fixture_id: {first_fixture_id}')
-    except Exception as e:
-        logger_1st.error(f'manually_map_tpd_meeting_id(): first_fixture_id: {first_fixture_id}')
-        logger_1st.error(traceback.format_exc())
+# reconciliation only looks at rows whose fixture is recent or that changed since the previous run,
+# so entries that can never be mapped stop being retried once they fall out of the window
+TPD_RECONCILE_WINDOW_DAYS = int(os.environ.get('TPD_RECONCILE_WINDOW_DAYS', 7))
+tpd_reconcile_watermark = JobWatermark('tpd_reconcile')  # when the previous run started
+
+# map_* natural keys are utf8_bin, first_* columns use the default collation, hence the BINARY comparisons.
+# existing map_* rows are skipped with a no-op ON DUPLICATE KEY UPDATE rather than INSERT IGNORE, which would also
+# turn truncation and other errors into warnings. keys longer than map_course_code / runner_number are left unmapped.
+TPD_RECONCILE_SQL = {
+    'meeting': {
+        'insert': """
+            INSERT INTO map_meeting (map_course_code, date)
+            SELECT DISTINCT t.tpd_course_id, f.fixture_date
+            FROM first_fixture f
+            JOIN first_track t ON t.track_id = f.track_id
+            WHERE f.tpd_meeting_id IS NULL AND t.tpd_course_id IS NOT NULL AND f.fixture_date IS NOT NULL
+              AND CHAR_LENGTH(t.tpd_course_id) <= 4
+              AND (f.fixture_date >= :since_date OR f.updated_at >= :last_run_at)
+            ON DUPLICATE KEY UPDATE id = map_meeting.id
+        """,
+        'update': """
+            UPDATE first_fixture f
+            JOIN first_track t ON t.track_id = f.track_id
+            JOIN map_meeting m ON m.map_course_code = BINARY t.tpd_course_id AND m.date = f.fixture_date
+            SET f.tpd_meeting_id = m.id
+            WHERE f.tpd_meeting_id IS NULL
+              AND (f.fixture_date >= :since_date OR f.updated_at >= :last_run_at)
+        """,
+        'unmapped': """
+            SELECT COUNT(*) FROM first_fixture f
+            WHERE f.tpd_meeting_id IS NULL
+              AND (f.fixture_date >= :since_date OR f.updated_at >= :last_run_at)
+        """,
+    },
+    'race': {
+        'insert': """
+            INSERT INTO map_race (map_meeting_id, race_number, post_time)
+            SELECT f.tpd_meeting_id, r.race_number, MIN(r.post_time)
+            FROM first_race r
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            WHERE r.tpd_race_id IS NULL AND f.tpd_meeting_id IS NOT NULL AND r.race_number IS NOT NULL AND r.post_time IS NOT NULL
+              AND (f.fixture_date >= :since_date OR r.updated_at >= :last_run_at)
+            GROUP BY f.tpd_meeting_id, r.race_number
+            ON DUPLICATE KEY UPDATE id = map_race.id
+        """,
+        'update': """
+            UPDATE first_race r
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            JOIN map_race mr ON mr.map_meeting_id = f.tpd_meeting_id AND mr.race_number = r.race_number
+            SET r.tpd_race_id = mr.id
+            WHERE r.tpd_race_id IS NULL
+              AND (f.fixture_date >= :since_date OR r.updated_at >= :last_run_at)
+        """,
+        'unmapped': """
+            SELECT COUNT(*) FROM first_race r
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            WHERE r.tpd_race_id IS NULL
+              AND (f.fixture_date >= :since_date OR r.updated_at >= :last_run_at)
+        """,
+    },
+    'runner': {
+        'insert': """
+            INSERT INTO map_runner (map_race_id, runner_number)
+            SELECT DISTINCT r.tpd_race_id, TRIM(e.program_number)
+            FROM first_entry e
+            JOIN first_race r ON r.race_id = e.race_id
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            WHERE e.tpd_runner_id IS NULL AND r.tpd_race_id IS NOT NULL AND TRIM(e.program_number) <> ''
+              AND CHAR_LENGTH(TRIM(e.program_number)) <= 8
+              AND (f.fixture_date >= :since_date OR e.updated_at >= :last_run_at)
+            ON DUPLICATE KEY UPDATE id = map_runner.id
+        """,
+        'update': """
+            UPDATE first_entry e
+            JOIN first_race r ON r.race_id = e.race_id
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            JOIN map_runner mu ON mu.map_race_id = r.tpd_race_id AND mu.runner_number = BINARY TRIM(e.program_number)
+            SET e.tpd_runner_id = mu.id
+            WHERE e.tpd_runner_id IS NULL
+              AND (f.fixture_date >= :since_date OR e.updated_at >= :last_run_at)
+        """,
+        'unmapped': """
+            SELECT COUNT(*) FROM first_entry e
+            JOIN first_race r ON r.race_id = e.race_id
+            JOIN first_fixture f ON f.fixture_id = r.fixture_id
+            WHERE e.tpd_runner_id IS NULL
+              AND (f.fixture_date >= :since_date OR e.updated_at >= :last_run_at)
+        """,
+    },
+}
 
 
-def manually_map_tpd_race_id(first_race_id :str) -> int:
+def manually_map_all_tpd_ids():
+    '''
+    set-based reconciliation of tpd_meeting_id, tpd_race_id and tpd_runner_id.
+    each level creates the missing map_* rows with one INSERT ... SELECT and maps with one UPDATE ... JOIN,
+    restricted to fixtures within TPD_RECONCILE_WINDOW_DAYS or rows changed since the previous run.
+    '''
+    logger_1st.info(f'tpd mapping cache: {get_mapping_cache_stats()}')
+    start_time = time.perf_counter()
     try:
-        if first_race_id is None:
-            logger_1st.error(f'manually_map_tpd_race_id(): first_race_id is None')
-            return None
-        with session_scope() as session:
-            existing_race = session.query(
-                FirstFixture.tpd_meeting_id,
-                FirstRace.race_number,
-                FirstRace.post_time
-            ).outerjoin(
-                FirstRace, FirstFixture.fixture_id == FirstRace.fixture_id).filter(
-                    FirstRace.race_id == first_race_id).first()
-            if existing_race:
-                tpd_meeting_id =  existing_race.tpd_meeting_id
-                race_number = existing_race.race_number
-                post_time = existing_race.post_time
-            else:
-                logger_1st.error(f'manually_map_tpd_race_id(): no tpd_meeting_id for first_race_id: {first_race_id}')
-                return None
-
-        tpd_race_id = get_tpd_race_id(tpd_meeting_id = tpd_meeting_id, race_number = race_number, post_time = post_time)
-        if not tpd_race_id:
-            return None
-        
-        with session_scope() as session:
-            existing_race = session.query(FirstRace).filter(FirstRace.race_id == first_race_id).first()
-            if existing_race:
-                existing_race.tpd_race_id = tpd_race_id
-                session.commit()
-                logger_1st.info(f'manually mapped tpd_race_id: {tpd_race_id} for first_race_id: {first_race_id}')
-    except Exception as e:
-        logger_1st.error(f'manually_map_tpd_race_id(): first_race_id: {first_race_id}')
-        logger_1st.error(traceback.format_exc())
-
+        with session_scope(raise_error=True) as session:
+            run_started_at = session.execute(text('SELECT NOW()')).scalar()
+        params = {
+            'since_date': run_started_at.date() - timedelta(days=TPD_RECONCILE_WINDOW_DAYS),
+            'last_run_at': tpd_reconcile_watermark.get(),
+        }
 
-def manually_map_tpd_runner_id(first_entry_id :str) -> int:
-    try:
-        if first_entry_id is None:
-            logger_1st.error(f'manually_map_tpd_runner_id(): first_entry_id is None')
-            return None
-        with session_scope() as session:
-            existing_entry = session.query(
-                FirstRace.tpd_race_id,
-                FirstEntry.program_number
-            ).outerjoin(
-                FirstRace, FirstEntry.race_id == FirstRace.race_id).filter(
-                        FirstEntry.entry_id == first_entry_id).first()
-            if existing_entry:
-                tpd_race_id = existing_entry.tpd_race_id
-                program_number = existing_entry.program_number
-            else:
-                logger_1st.error(f'manually_map_tpd_runner_id(): no tpd_race_id for first_entry_id: {first_entry_id}')
-                return None
-
-        tpd_runner_id = get_tpd_runner_id(tpd_race_id = tpd_race_id, program_number = program_number)
-        if not tpd_runner_id:
-            return None
+        summary = {}
+        for level, statements in TPD_RECONCILE_SQL.items():
+            with session_scope(raise_error=True) as session:
+                session.execute(text(statements['insert']), params)
+                mapped = session.execute(text(statements['update']), params).rowcount
+                unmapped = session.execute(text(statements['unmapped']), params).scalar()
+            summary[level] = {'mapped': mapped, 'unmapped': unmapped}
 
-        with session_scope() as session:
-            existing_entry = session.query(FirstEntry).filter(FirstEntry.entry_id == first_entry_id).first()
-            if existing_entry:
-                existing_entry.tpd_runner_id = tpd_runner_id
-                session.commit()
-                logger_1st.info(f'manually mapped tpd_runner_id: {tpd_runner_id} for first_entry_id: {first_entry_id}')
+        tpd_reconcile_watermark.set(run_started_at)
+        logger_1st.info(f'manually_map_all_tpd_ids(): {summary} | since: {params["since_date"]}, last_run_at: {params["last_run_at"]} | {time.perf_counter() - start_time:.2f} seconds')
     except Exception as e:
-        logger_1st.error(f'manually_map_tpd_runner_id(): first_entry_id: {first_entry_id}')
+        logger_1st.error(f'manually_map_all_tpd_ids(): {e}')
         logger_1st.error(traceback.format_exc())
 
 
-def get_tpd_meeting_id(track_id :str, fixture_date :date) -> int:
-    track_id = str(track_id).strip()
-    track_id = None if track_id == '' else track_id
-    if track_id is None or fixture_date is None:
-        logger_1st.error(f'get_tpd_meeting_id(): track_id: {track_id}, fixture_date: {fixture_date} is not valid')
-        return None
-
-    tpd_meeting_id = None
-    try:
-        with session_scope() as session:
-            result = session.query(FirstTrack.tpd_course_id).filter(FirstTrack.track_id == track_id).first()
-            if result:
-                tpd_course_id = result.tpd_course_id
-            else:
-                tpd_course_id = None
-                logger_1st.error(f'get_tpd_meeting_id(): track_id: {track_id} not found in first_track table')
-        if tpd_course_id is None:
-            logger_1st.error(f'get_tpd_meeting_id(): track_id: {track_id} is not mapped')
-            return None
-
-        with session_scope() as session:
-            existing_meeting = session.query(MapMeeting.id).filter(
-                MapMeeting.map_course_code == tpd_course_id, 
-                MapMeeting.date == fixture_date).first()
-            if existing_meeting:
-                tpd_meeting_id = existing_meeting.id
-            else:
-                new_meeting = MapMeeting(
-                    map_course_code = tpd_course_id,
-                    date = fixture_date,
-                )
-                session.add(new_meeting)
-                session.flush()
-                session.refresh(new_meeting)
-                session.commit()
-                tpd_meeting_id = new_meeting.id
-    except Exception as e:
-        logger_1st.error(f'get_tpd_meeting_id(): track_id: {track_id}, fixture_date: {fixture_date}')
-        logger_1st.error(traceback.format_exc())
-    return tpd_meeting_id
-
+def resolve_tpd_ids(fixtures: list) -> None:
+    '''
+    fill tpd_meeting_id, tpd_race_id and tpd_runner_id in place for a whole processed message.
+    every key is collected first, then each level (courses, meetings, races, runners) is resolved from the mapping caches
+    and, for the misses only, with one bulk select plus one bulk insert of the missing map_* rows.
+    '''
+    if not fixtures:
+        return
 
-def get_tpd_race_id(tpd_meeting_id :int, race_number :int, post_time :datetime) -> int | None:
-    if tpd_meeting_id is None or race_number is None or post_time is None:
-        logger_1st.error(f'get_tpd_race_id(): tpd_meeting_id: {tpd_meeting_id}, race_number: {race_number}, post_time: {post_time} is not valid')
-        return None
-    tpd_race_id = None
     try:
-        with session_scope() as session:
-            existing_race = session.query(MapRace.id).filter(
-                MapRace.map_meeting_id == tpd_meeting_id,
-                MapRace.race_number == race_number).first()
-            if existing_race:
-                tpd_race_id = existing_race.id
-            else:
-                new_race = MapRace(
-                    map_meeting_id = tpd_meeting_id,
-                    race_number = race_number,
-                    post_time = post_time,
-                )
-                session.add(new_race)
-                session.flush()
-                session.refresh(new_race)
-                session.commit()
-                tpd_race_id = new_race.id
+        with session_scope(raise_error=True) as session:
+            # track_id -> tpd_course_id
+            track_ids = {normalize_key(fixture.get('track_id')) for fixture in fixtures} - {None}
+            course_ids = {}
+            for track_id in track_ids:
+                tpd_course_id = tpd_course_cache.get(track_id)
+                if tpd_course_id is not None:
+                    course_ids[track_id] = tpd_course_id
+            missing_track_ids = [track_id for track_id in track_ids if track_id not in course_ids]
+            for chunk in chunked(missing_track_ids):
+                for track_id, tpd_course_id in session.query(FirstTrack.track_id, FirstTrack.tpd_course_id).filter(FirstTrack.track_id.in_(chunk)):
+                    if tpd_course_id is not None:
+                        course_ids[track_id] = tpd_course_id
+                        tpd_course_cache.set(track_id, tpd_course_id)
+
+            # (tpd_course_id, fixture_date) -> map_meeting.id
+            meeting_keys = {}
+            for fixture in fixtures:
+                tpd_course_id = course_ids.get(normalize_key(fixture.get('track_id')))
+                if tpd_course_id is not None and fixture.get('fixture_date') is not None:
+                    meeting_keys[id(fixture)] = (tpd_course_id, fixture['fixture_date'])
+            meeting_ids = resolve_level(session, tpd_meeting_cache, MapMeeting, ['map_course_code', 'date'], {
+                key: {'map_course_code': key[0], 'date': key[1]} for key in meeting_keys.values()
+            })
+            for fixture in fixtures:
+                fixture['tpd_meeting_id'] = meeting_ids.get(meeting_keys.get(id(fixture)))
+
+            # (map_meeting.id, race_number) -> map_race.id
+            race_keys = {}
+            race_rows = {}
+            for fixture in fixtures:
+                for race in fixture.get('race_data', []):
+                    if fixture['tpd_meeting_id'] is None or race.get('race_number') is None or race.get('post_time') is None:
+                        continue
+                    key = (fixture['tpd_meeting_id'], race['race_number'])
+                    race_keys[id(race)] = key
+                    race_rows.setdefault(key, {'map_meeting_id': key[0], 'race_number': key[1], 'post_time': race['post_time']})
+            race_ids = resolve_level(session, tpd_race_cache, MapRace, ['map_meeting_id', 'race_number'], race_rows)
+
+            # (map_race.id, program_number) -> map_runner.id
+            runner_keys = {}
+            for fixture in fixtures:
+                for race in fixture.get('race_data', []):
+                    race['tpd_race_id'] = race_ids.get(race_keys.get(id(race)))
+                    for entry in race.get('entry_data', []):
+                        program_number = normalize_key(entry.get('program_number'))
+                        if race['tpd_race_id'] is not None and program_number is not None:
+                            runner_keys[id(entry)] = (race['tpd_race_id'], program_number)
+            runner_ids = resolve_level(session, tpd_runner_cache, MapRunner, ['map_race_id', 'runner_number'], {
+                key: {'map_race_id': key[0], 'runner_number': key[1]} for key in runner_keys.values()
+            })
+            for fixture in fixtures:
+                for race in fixture.get('race_data', []):
+                    for entry in race.get('entry_data', []):
+                        entry['tpd_runner_id'] = runner_ids.get(runner_keys.get(id(entry)))
+
+        unmapped_fixtures = [fixture.get('fixture_id') for fixture in fixtures if fixture.get('tpd_meeting_id') is None]
+        if unmapped_fixtures:
+            logger_1st.error(f'resolve_tpd_ids(): no tpd_meeting_id for fixture_ids: {unmapped_fixtures}')
     except Exception as e:
-        logger_1st.error(f'get_tpd_race_id(): tpd_meeting_id: {tpd_meeting_id}, race_number: {race_number}, post_time: {post_time}')
+        logger_1st.error(f'resolve_tpd_ids(): fixture_ids: {[fixture.get("fixture_id") for fixture in fixtures]}')
         logger_1st.error(traceback.format_exc())
-    return tpd_race_id
 
 
-def get_tpd_runner_id(tpd_race_id :int, program_number :str) -> int:
-    program_number = str(program_number).strip() if program_number is not None else None
-    program_number = None if program_number == '' else program_number
-    if tpd_race_id is None or program_number is None:
-        logger_1st.error(f'get_tpd_runner_id(): tpd_race_id: {tpd_race_id}, program_number: {program_number} is not valid')
-        return None
-    tpd_runner_id = None
-    try:
-        with session_scope() as session:
-            existing_runner = session.query(MapRunner.id).filter(
-                MapRunner.map_race_id == tpd_race_id,
-                MapRunner.runner_number == program_number).first()
-            if existing_runner:
-                tpd_runner_id = existing_runner.id
-            else:
-                new_runner = MapRunner(
-                    map_race_id = tpd_race_id,
-                    runner_number = program_number,
-                )
-                session.add(new_runner)
-                session.flush()
-                session.refresh(new_runner)
-                session.commit()
-                tpd_runner_id = new_runner.id
-    except Exception as e:
-        logger_1st.error(f'get_tpd_runner_id(): tpd_race_id: {tpd_race_id}, program_number: {program_number}')
-        logger_1st.error(traceback.format_exc())
-    return tpd_runner_id
+def resolve_level(session, cache, model, key_columns: list[str], rows: dict) -> dict:
+    '''
+    resolve {key: row to insert} to {key: id}, serving hits from cache and sending only the misses to the database.
+    '''
+    ids = {}
+    for key in rows:
+        cached_id = cache.get(key)
+        if cached_id is not None:
+            ids[key] = cached_id
+    missing_rows = {key: row for key, row in rows.items() if key not in ids}
+    if missing_rows:
+        for key, resolved_id in bulk_get_or_create_ids(session, model, key_columns, missing_rows).items():
+            ids[key] = resolved_id
+            cache.set(key, resolved_id)
+    return ids
+
+
+def normalize_key(value) -> str | None:
+    value = str(value).strip() if value is not None else None
+    return None if value == '' else value
 
 
 def generate_race_class(total_prize: int, currency: str, country_name: str) -> str:
@@ -1,5 +1,5 @@
 import traceback
-from dateutil.parser import parse
+from utils.timestamps import parse_timestamp
 from utils.logger import logger_1st
 
 
@@ -22,7 +22,7 @@ def process_horse_data(horse_data: dict) -> dict | None:
         gender = horse_data.get('gender', {}).get('details')
         breed = horse_data.get('breed', {}).get('details')
         foaling_date_str = horse_data.get('foaling', {}).get('date')
-        foaling_date = parse(foaling_date_str).date() if foaling_date_str else None
+        foaling_date = parse_timestamp(foaling_date_str).date() if foaling_date_str else None
         foaling_country = horse_data.get('foaling', {}).get('country')
         color = horse_data.get('color', {}).get('details')
         breeder = horse_data.get('breeder')
@@ -0,0 +1,84 @@
+import os
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.dialects.mysql import insert
+from database.general import session_scope, FirstPriceHistory, FirstRaceStatusHistory, FirstJobState
+from database.bulk import chunked
+from utils.cache import BoundedCache
+
+
+HISTORY_WATERMARK_CACHE_SIZE = int(os.environ.get('HISTORY_WATERMARK_CACHE_SIZE', 200_000))
+NOTHING_STORED = datetime.min
+
+
+def to_naive(timestamp: datetime) -> datetime:
+    # pymysql writes the wall time of aware datetimes and drops the offset, compare the same way
+    return timestamp.replace(tzinfo=None)
+
+
+class HistoryWatermarks:
+    '''
+    newest stored history timestamp per key (entry_id for prices, race_id for race status),
+    bounded in memory and warmed from the database with one grouped MAX() per chunk of missing keys.
+    '''
+
+    def __init__(self, name: str, timestamp_column, key_column, max_size: int = HISTORY_WATERMARK_CACHE_SIZE):
+        self.cache = BoundedCache(name, max_size=max_size)
+        self.timestamp_column = timestamp_column
+        self.key_column = key_column
+
+    def get_many(self, keys) -> dict:
+        '''
+        {key: newest stored timestamp}, NOTHING_STORED for keys without history.
+        '''
+        watermarks = {}
+        missing_keys = []
+        for key in set(keys):
+            watermark = self.cache.get(key)
+            if watermark is None:
+                missing_keys.append(key)
+            else:
+                watermarks[key] = watermark
+
+        if missing_keys:
+            with session_scope(raise_error=True) as session:
+                for chunk in chunked(missing_keys):
+                    rows = session.query(self.key_column, func.max(self.timestamp_column)).filter(
+                        self.key_column.in_(chunk)).group_by(self.key_column)
+                    for key, timestamp in rows:
+                        watermarks[key] = timestamp or NOTHING_STORED
+            for key in missing_keys:
+                watermarks.setdefault(key, NOTHING_STORED)
+                self.cache.set(key, watermarks[key])
+        return watermarks
+
+    def advance(self, watermarks: dict):
+        '''
+        move watermarks forward once the ticks up to them are committed.
+        '''
+        for key, timestamp in watermarks.items():
+            current = self.cache.get(key)
+            if current is None or timestamp > current:
+                self.cache.set(key, timestamp)
+
+
+class JobWatermark:
+    '''
+    watermark of a periodic job (e.g. when it last ran) kept in first_job_state, so it survives restarts.
+    '''
+
+    def __init__(self, job: str):
+        self.job = job
+
+    def get(self) -> datetime | None:
+        with session_scope(raise_error=True) as session:
+            return session.execute(select(FirstJobState.watermark).where(FirstJobState.job == self.job)).scalar()
+
+    def set(self, watermark: datetime):
+        stmt = insert(FirstJobState.__table__).values(job=self.job, watermark=watermark)
+        with session_scope(raise_error=True) as session:
+            session.execute(stmt.on_duplicate_key_update(watermark=stmt.inserted.watermark))
+
+
+price_watermarks = HistoryWatermarks('price_watermark', FirstPriceHistory.timestamp, FirstPriceHistory.entry_id)
+race_status_watermarks = HistoryWatermarks('race_status_watermark', FirstRaceStatusHistory.timestamp, FirstRaceStatusHistory.race_id)
@@ -1,100 +1,308 @@
-import json
+import os
+import asyncio
 import time
 import boto3
 import config
 import schedule
 import threading
 import traceback
-from first import FirstAPI
+from concurrent.futures import Future, ThreadPoolExecutor
+from first import FirstAPI, AsyncFirstAPI, log_api_stats
 from datetime import date, timedelta
-from database.s3 import upload_to_s3
+from database.archive import archiver, make_record
+from database.parquet_export import export_to_parquet
+from database.bulk import chunked
+from database.claim_check import is_claim_check, get_pointer
 from process.fixture_push import process_fixture_from_push
-from process.fixture_pull import process_fixture_from_pull
-from upload.fixture_push import upload_fixture_from_push
+from upload.fixture_push import bulk_upload_fixtures_from_push
 from upload.price_history import bulk_insert_price_history_data
 from upload.race_status_history import bulk_insert_race_status_history_data
-from upload.fixture_pull import upload_fixture_from_pull
-from upload.horse import bulk_insert_horse_data
-from upload.jockey import bulk_insert_jockey_data
-from upload.trainer import bulk_insert_trainer_data
-from upload.owner import bulk_insert_owner_data
+from upload.fixture_pull import ingest_fixture_pull
+from upload.horse import run_horse_enrichment
+from race_poller import run_race_poller
 from process.helper import manually_map_all_tpd_ids
 from utils.logger import logger_1st
+from utils.worker_pool import KeyedWorkerPool
+from process.watermark import price_watermarks, race_status_watermarks
+from database.fingerprint import fixture_fingerprints
+from utils import fast_json
+from utils.http_cache import get_response_cache
+from utils.compression import decompress
+from utils.sqs_message import read_message_payload
 
 sqs_client = boto3.client('sqs')
 
 
-def process_sqs_messages():
+SQS_BATCH_SIZE = 10
+SQS_WORKERS = int(os.environ.get('SQS_WORKERS', 4))
+SQS_MAX_IN_FLIGHT = int(os.environ.get('SQS_MAX_IN_FLIGHT', 100))
+SQS_VISIBILITY_TIMEOUT = int(os.environ.get('SQS_VISIBILITY_TIMEOUT', 120))
+
+# receipt handle -> time the message was received or its visibility was last extended
+sqs_in_flight = {}
+sqs_in_flight_lock = threading.Lock()
+sqs_delete_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqs-delete')
+
+
+def process_sqs_messages(batch_size: int = SQS_BATCH_SIZE, num_workers: int = SQS_WORKERS):
+    '''
+    receive push messages and hand them to a pool of workers routed by fixture_id,
+    so one fixture's updates are applied in order while different fixtures are written in parallel.
+    '''
+    fixture_fingerprints.load()
+    pool = KeyedWorkerPool(handle_sqs_items, num_workers=num_workers, max_in_flight=SQS_MAX_IN_FLIGHT, batch_size=batch_size, name='sqs').start()
+    threading.Thread(target=extend_sqs_visibility, daemon=True).start()
     try:
         while True:
-            response = sqs_client.receive_message(QueueUrl=config.SQS_QUEUE_URL, MaxNumberOfMessages=1, WaitTimeSeconds=20)
-            if 'Messages' in response:
-                for message in response['Messages']:
-
-                    try:
-                        data = json.loads(message['Body'])
-                        fixture_data = process_fixture_from_push(data)
-                        fixtures = fixture_data['fixtures']
-                        race_status_history_dict = fixture_data['race_status_history_dict']
-                        price_history_dict = fixture_data['price_history_dict']
-
-                        for fixture in fixtures:
-                            upload_fixture_from_push(fixture, overwrite=True)
-
-                        bulk_insert_race_status_history_data(race_status_history_dict)
-                        bulk_insert_price_history_data(price_history_dict)
-                        upload_to_s3(file_content=json.dumps(data), s3_subdir='1st/processed')
-                        sqs_client.delete_message(QueueUrl=config.SQS_QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
-
-                    except Exception as e:
-                        logger_1st.error(f'process_sqs_messages(): {e}')
-                        logger_1st.error(traceback.format_exc())
-                        upload_to_s3(file_content=message['Body'], s3_subdir='1st/unprocessed')
-                        continue
+            response = sqs_client.receive_message(QueueUrl=config.SQS_QUEUE_URL, MaxNumberOfMessages=batch_size, WaitTimeSeconds=20, VisibilityTimeout=SQS_VISIBILITY_TIMEOUT, AttributeNames=['SentTimestamp'], MessageAttributeNames=['All'])
+            messages = response.get('Messages', [])
+            with sqs_in_flight_lock:
+                for message in messages:
+                    sqs_in_flight[message['ReceiptHandle']] = time.monotonic()
+            for message in sorted(messages, key=get_sent_timestamp):
+                data = parse_sqs_message(message)
+                pool.submit(get_fixture_key(data), (message, data))
 
     except KeyboardInterrupt:
         logger_1st.info('Keyboard interrupt detected. Exiting...')
     except Exception as e:
         logger_1st.error(f'process_sqs_messages(): {e}')
         logger_1st.error(traceback.format_exc())
+    finally:
+        pool.stop()
+        fixture_fingerprints.save()
+
+
+def handle_sqs_items(items: list):
+    archived = []
+    try:
+        archived = process_sqs_message_batch(items)
+    finally:
+        # processed messages stay in flight (and invisible) until delete_when_archived() is done with them
+        archived_handles = {message['ReceiptHandle'] for message, _ in archived}
+        release_sqs_messages([message for message, _ in items if message['ReceiptHandle'] not in archived_handles])
+    if archived:
+        delete_when_archived(archived)
+
+
+def release_sqs_messages(messages: list):
+    with sqs_in_flight_lock:
+        for message in messages:
+            sqs_in_flight.pop(message['ReceiptHandle'], None)
+
+
+def delete_when_archived(archived: list):
+    '''
+    delete the messages of [(message, archive future)] as one batch once the archiver wrote all their records.
+    a message whose record was lost is not deleted and comes back after its visibility timeout.
+    '''
+    remaining = [len(archived)]
+    lock = threading.Lock()
+
+    def delete_archived():
+        try:
+            delete_sqs_messages([message for message, future in archived if future.exception() is None])
+        finally:
+            release_sqs_messages([message for message, _ in archived])
+
+    def on_archived(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        # callbacks run on the archiver thread, the sqs calls do not
+        sqs_delete_executor.submit(delete_archived)
+
+    for _, future in archived:
+        future.add_done_callback(on_archived)
+
+
+def extend_sqs_visibility(interval: float = 10):
+    '''
+    keep long-running in-flight messages invisible: anything held for more than half the visibility timeout
+    gets its timeout reset, so a slow write does not hand the message to another consumer.
+    '''
+    while True:
+        time.sleep(interval)
+        try:
+            now = time.monotonic()
+            with sqs_in_flight_lock:
+                receipt_handles = [receipt_handle for receipt_handle, since in sqs_in_flight.items() if now - since > SQS_VISIBILITY_TIMEOUT / 2]
+                for receipt_handle in receipt_handles:
+                    sqs_in_flight[receipt_handle] = now
+            for chunk in chunked(receipt_handles, SQS_BATCH_SIZE):
+                entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': SQS_VISIBILITY_TIMEOUT} for i, receipt_handle in enumerate(chunk)]
+                response = sqs_client.change_message_visibility_batch(QueueUrl=config.SQS_QUEUE_URL, Entries=entries)
+                for failed in response.get('Failed', []):
+                    logger_1st.error(f'extend_sqs_visibility(): {failed}')
+        except Exception as e:
+            logger_1st.error(f'extend_sqs_visibility(): {e}')
+            logger_1st.error(traceback.format_exc())
+
+
+def get_sent_timestamp(message: dict) -> int:
+    return int(message.get('Attributes', {}).get('SentTimestamp', 0))
+
+
+def parse_sqs_message(message: dict) -> dict | None:
+    try:
+        payload, content_encoding = read_message_payload(message)
+        return fast_json.loads(decompress(payload, content_encoding))
+    except Exception as e:
+        logger_1st.error(f'parse_sqs_message(): {e}')
+        return None
+
+
+def archive_sqs_message(message: dict, s3_subdir: str, verified: bool = False) -> Future:
+    '''
+    queue the decompressed body for the background archiver, claim-checked bodies are already stored
+    and only their pointer is archived. verified: the body is known to be valid json, see make_record().
+    returns the archiver's future for the record.
+    '''
+    sent_timestamp = get_sent_timestamp(message)
+    try:
+        if is_claim_check(message):
+            return archiver.append(s3_subdir, make_record('push', sent_timestamp=sent_timestamp, claim_check=get_pointer(message)))
+        payload, content_encoding = read_message_payload(message)
+        return archiver.append(s3_subdir, make_record('push', decompress(payload, content_encoding), verified=verified, sent_timestamp=sent_timestamp))
+    except Exception as e:
+        logger_1st.error(f'archive_sqs_message(): {e}')
+        logger_1st.error(traceback.format_exc())
+        return archiver.append(s3_subdir, make_record('push', sent_timestamp=sent_timestamp, body=message['Body'], attributes=message.get('MessageAttributes', {})))
+
+
+def get_fixture_key(data: dict | None) -> str | None:
+    '''
+    routing key for a push message, the lowest fixture id it carries (pushes normally carry a single fixture).
+    '''
+    try:
+        fixture_ids = [str(fixture.get('header', {}).get('id')) for fixture in data.get('fixtures', [])]
+        return min(fixture_ids) if fixture_ids else None
+    except Exception:
+        return None
+
+
+def process_sqs_message_batch(items: list) -> list:
+    '''
+    process a batch of (message, parsed body) push items and write them together, one bulk write per table.
+    a message that fails to parse or process is archived as unprocessed without blocking the rest,
+    and if the combined write fails each message is written on its own so only the bad one is held back.
+    returns (message, archive future) for the messages that were written, they can be deleted once archived.
+    '''
+    processed = []
+    for message, data in items:
+        try:
+            if data is None:
+                raise ValueError('message body is not valid json')
+            processed.append((message, data, process_fixture_from_push(data)))
+        except Exception as e:
+            logger_1st.error(f'process_sqs_message_batch(): {e}')
+            logger_1st.error(traceback.format_exc())
+            archive_sqs_message(message, '1st/unprocessed')
+
+    if not processed:
+        return []
+
+    if not write_push_batch([fixture_data for _, _, fixture_data in processed]):
+        logger_1st.warning(f'process_sqs_message_batch(): batch write of {len(processed)} messages failed, writing one by one')
+        written = []
+        for message, data, fixture_data in processed:
+            if write_push_batch([fixture_data]):
+                written.append((message, data, fixture_data))
+            else:
+                archive_sqs_message(message, '1st/unprocessed')
+        processed = written
+
+    return [(message, archive_sqs_message(message, '1st/processed', verified=True)) for message, _, _ in processed]
+
+
+def write_push_batch(fixture_data_list: list) -> bool:
+    '''
+    merge processed push messages (oldest first) and write them with one bulk write per table.
+    bulk_upsert keeps the last row per primary key, so the newest fixture, race and entry state wins.
+    history watermarks are only advanced after every table was written.
+    '''
+    fixtures = []
+    race_status_history_dict = {}
+    price_history_dict = {}
+    for fixture_data in fixture_data_list:
+        fixtures.extend(fixture_data['fixtures'])
+        race_status_history_dict.update(fixture_data['race_status_history_dict'])
+        price_history_dict.update(fixture_data['price_history_dict'])
+
+    if fixtures and bulk_upload_fixtures_from_push(fixtures, overwrite=True) is None:
+        return False
+    if race_status_history_dict and not bulk_insert_race_status_history_data(race_status_history_dict):
+        return False
+    if price_history_dict and not bulk_insert_price_history_data(price_history_dict):
+        return False
+
+    for fixture_data in fixture_data_list:
+        price_watermarks.advance(fixture_data.get('price_watermarks', {}))
+        race_status_watermarks.advance(fixture_data.get('race_status_watermarks', {}))
+    return True
+
+
+def delete_sqs_messages(messages: list):
+    for chunk in chunked(messages, SQS_BATCH_SIZE):
+        try:
+            entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(chunk)]
+            response = sqs_client.delete_message_batch(QueueUrl=config.SQS_QUEUE_URL, Entries=entries)
+            for failed in response.get('Failed', []):
+                logger_1st.error(f'delete_sqs_messages(): {failed}')
+        except Exception as e:
+            logger_1st.error(f'delete_sqs_messages(): {e}')
+            logger_1st.error(traceback.format_exc())
         
 
+def ingest_fofixtures_day(first_api: FirstAPI, meeting_date: date, fixture_data: bytes):
+    fofixtures_url = first_api.fofixtures_url(date=meeting_date)
+    if not first_api.has_changed(fofixtures_url):
+        logger_1st.info(f'Skipping {meeting_date} | unchanged since last processed')
+        return
+    logger_1st.info(f'Processing {meeting_date} | bytes: {len(fixture_data)}')
+    if ingest_fixture_pull(fixture_data, meeting_date=meeting_date):
+        first_api.mark_processed(fofixtures_url)
+
+
+async def collect_fofixtures(first_api: AsyncFirstAPI, list_of_days: list) -> bool:
+    '''
+    fetch and ingest the days in order, fetching the next day while the current one is ingested,
+    so at most two raw bodies are held at a time.
+    '''
+    next_fetch = asyncio.create_task(first_api.get_fofixtures_body(date=list_of_days[0]))
+    for index, meeting_date in enumerate(list_of_days):
+        fixture_data = await next_fetch
+        if not fixture_data:
+            logger_1st.error(f'No fixture data for {meeting_date}')
+            return False
+        if index + 1 < len(list_of_days):
+            next_fetch = asyncio.create_task(first_api.get_fofixtures_body(date=list_of_days[index + 1]))
+        try:
+            await asyncio.to_thread(ingest_fofixtures_day, first_api.client, meeting_date, fixture_data)
+        except Exception as e:
+            logger_1st.error(f'Error processing {meeting_date}: {e}')
+            logger_1st.error(traceback.format_exc())
+        fixture_data = None
+    return True
+
+
 def manual_data_collection():
-    first_api = FirstAPI()
+    first_api = AsyncFirstAPI(FirstAPI(cache=get_response_cache()))
     list_of_days = [date.today() - timedelta(days=1),
                     date.today(),
                     date.today() + timedelta(days=1),
                     date.today() + timedelta(days=2),]  
-    for meeting_date in list_of_days:
-        try:
-            fixture_data = first_api.get_fofixtures(date=meeting_date)
-            if not fixture_data:
-                logger_1st.error(f'No fixture data for {meeting_date}')
-                return False
-            fixture_result = process_fixture_from_pull(fixture_data)
-            fixtures = fixture_result['fixtures']
-            horse_dict = fixture_result['horse_dict']
-            jockey_dict = fixture_result['jockey_dict']
-            trainer_dict = fixture_result['trainer_dict']
-            owner_dict = fixture_result['owner_dict']
-            logger_1st.info(f'Uploading fixture: {len(fixtures)}')
-            for fixture in fixtures:
-                upload_fixture_from_pull(fixture, overwrite=True)
-            bulk_insert_jockey_data(jockey_dict)
-            bulk_insert_trainer_data(trainer_dict)
-            bulk_insert_owner_data(owner_dict)
-            bulk_insert_horse_data(horse_dict)
-            upload_to_s3(file_content=json.dumps(fixture_data), s3_subdir='1st/processed')
-            logger_1st.info(f'Processing {meeting_date} | items: {len(fixture_data)}')
-        except Exception as e:
-            logger_1st.error(f'Error processing {meeting_date}: {e}')
-            logger_1st.error(traceback.format_exc())
-            upload_to_s3(file_content=json.dumps(fixture_data), s3_subdir='1st/unprocessed')
+    return asyncio.run(collect_fofixtures(first_api, list_of_days))
             
 
 def schedule_jobs():
     schedule.every(1).day.at('02:30').do(manual_data_collection)
     schedule.every(1).hour.do(manually_map_all_tpd_ids)
+    schedule.every(10).minutes.do(fixture_fingerprints.save)
+    schedule.every(1).hour.do(log_api_stats)
+    if os.environ.get('PARQUET_EXPORT_ROOT'):
+        schedule.every(1).day.at('03:30').do(export_to_parquet)
     while True:
         schedule.run_pending()
         time.sleep(1)
@@ -103,13 +311,19 @@ def schedule_jobs():
 def run_concurrent_tasks():
     sqs_thread = threading.Thread(target=process_sqs_messages, daemon=True)
     schedule_thread = threading.Thread(target=schedule_jobs, daemon=True)
+    horse_thread = threading.Thread(target=run_horse_enrichment, daemon=True)
+    race_poller_thread = threading.Thread(target=run_race_poller, daemon=True)
     sqs_thread.start()
     schedule_thread.start()
+    horse_thread.start()
+    race_poller_thread.start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         logger_1st.info('Keyboard interrupt detected. Shutting down...')
+    finally:
+        archiver.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+'''
+adaptive polling of fixtures with races near the off.
+
+the daily pull only refreshes a fixture once, so late changes (non-runners, jockey changes, going, results)
+otherwise only arrive through the push feed. the poller re-fetches a fixture on an interval that tightens
+as its next race approaches:
+
+    more than 2 h before the off      every hour
+    30 min - 2 h before               every 10 min
+    5 - 30 min before                 every 2 min
+    5 min before - 15 min after       every 15 s
+    15 - 60 min after                 every 2 min (results)
+    later                             not polled
+
+a fixture is polled on the shortest interval of its races, all polls share one request budget
+(RACE_POLL_REQUESTS_PER_MINUTE) and the most urgent fixture goes first when the budget is short.
+'''
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from database.general import mariadb_engine
+from first import FirstAPI
+from upload.fixture_pull import ingest_fixture_pull
+from utils.rate_limit import TokenBucket
+from utils.http_cache import get_response_cache
+from utils.logger import logger_1st
+
+
+RACE_POLL_WORKERS = int(os.environ.get('RACE_POLL_WORKERS', 4))
+RACE_POLL_REQUESTS_PER_MINUTE = float(os.environ.get('RACE_POLL_REQUESTS_PER_MINUTE', 30))
+# how often the race schedule is re-read from the database
+RACE_POLL_REFRESH_INTERVAL = float(os.environ.get('RACE_POLL_REFRESH_INTERVAL', 60))
+# (seconds to the off at least, poll interval in seconds), checked in order; races past the last tier are not polled
+RACE_POLL_TIERS = [
+    (2 * 60 * 60, float(os.environ.get('RACE_POLL_INTERVAL_FAR', 60 * 60))),
+    (30 * 60, float(os.environ.get('RACE_POLL_INTERVAL_NEAR', 10 * 60))),
+    (5 * 60, float(os.environ.get('RACE_POLL_INTERVAL_CLOSE', 2 * 60))),
+    (-15 * 60, float(os.environ.get('RACE_POLL_INTERVAL_OFF', 15))),
+    (-60 * 60, float(os.environ.get('RACE_POLL_INTERVAL_RESULT', 2 * 60))),
+]
+
+
+# seconds_to_post is computed by the database. post times are stored as the track's local wall time, so they are
+# moved to utc with the race's timezone_offset (the track's when the race has none, e.g. push-only races).
+# the offset is taken as hours when it is within +-14 and as minutes otherwise; races without any offset are skipped.
+RACE_SCHEDULE_SQL = text('''
+    SELECT fixture_id, TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), post_time_utc) AS seconds_to_post
+    FROM (
+        SELECT r.fixture_id,
+               COALESCE(r.estimated_post_time, r.post_time) - INTERVAL
+                   CASE WHEN ABS(COALESCE(r.timezone_offset, t.timezone_offset)) <= 14
+                        THEN COALESCE(r.timezone_offset, t.timezone_offset) * 60
+                        ELSE COALESCE(r.timezone_offset, t.timezone_offset) END MINUTE AS post_time_utc
+        FROM first_race r
+        JOIN first_fixture f ON f.fixture_id = r.fixture_id
+        LEFT JOIN first_track t ON t.track_id = f.track_id
+        WHERE f.fixture_date BETWEEN UTC_DATE() - INTERVAL 1 DAY AND UTC_DATE() + INTERVAL 1 DAY
+    ) races
+    WHERE post_time_utc > UTC_TIMESTAMP() - INTERVAL :lookback SECOND
+''')
+
+
+def get_poll_interval(seconds_to_post: float) -> float | None:
+    '''
+    poll interval for a race seconds_to_post away from the off (negative once it is past), none when done.
+    '''
+    for threshold, interval in RACE_POLL_TIERS:
+        if seconds_to_post >= threshold:
+            return interval
+    return None
+
+
+def get_fixture_intervals() -> dict:
+    '''
+    fixture_id -> shortest poll interval over its races that still need polling.
+    '''
+    lookback = -RACE_POLL_TIERS[-1][0]
+    with mariadb_engine.connect() as connection:
+        rows = connection.execute(RACE_SCHEDULE_SQL, {'lookback': lookback}).all()
+    intervals = {}
+    for fixture_id, seconds_to_post in rows:
+        interval = get_poll_interval(seconds_to_post) if seconds_to_post is not None else None
+        if interval is not None:
+            intervals[fixture_id] = min(interval, intervals.get(fixture_id, interval))
+    return intervals
+
+
+def poll_fixture(first_api: FirstAPI, fixture_id: str) -> bool:
+    '''
+    fetch one fixture and ingest it if its content changed since it was last processed.
+    '''
+    try:
+        fixture_data = first_api.get_fofixtures_body(fixture_id=fixture_id)
+        if not fixture_data:
+            return False
+        fofixtures_url = first_api.fofixtures_url(fixture_id=fixture_id)
+        if not first_api.has_changed(fofixtures_url):
+            return True
+        if not ingest_fixture_pull(fixture_data, fixture_id=fixture_id):
+            return False
+        first_api.mark_processed(fofixtures_url)
+        logger_1st.info(f'poll_fixture(): {fixture_id} updated')
+        return True
+    except Exception as e:
+        logger_1st.error(f'poll_fixture(): {fixture_id}: {e}')
+        logger_1st.error(traceback.format_exc())
+        return False
+
+
+def run_race_poller(num_workers: int = RACE_POLL_WORKERS, requests_per_minute: float = RACE_POLL_REQUESTS_PER_MINUTE):
+    '''
+    poll fixtures forever on their get_fixture_intervals() schedule. runs in its own thread.
+    '''
+    first_api = FirstAPI(cache=get_response_cache())
+    budget = TokenBucket(requests_per_minute / 60, max(requests_per_minute / 6, 1))
+    intervals = {}
+    next_poll = {}  # fixture_id -> monotonic time the fixture is due
+    in_flight = {}  # fixture_id -> future
+    refreshed_at = None
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='race-poller') as executor:
+        while True:
+            try:
+                now = time.monotonic()
+                if refreshed_at is None or now - refreshed_at >= RACE_POLL_REFRESH_INTERVAL:
+                    intervals = get_fixture_intervals()
+                    refreshed_at = now
+                    for fixture_id in list(next_poll):
+                        if fixture_id not in intervals:
+                            del next_poll[fixture_id]
+                    for fixture_id, interval in intervals.items():
+                        # a fixture moving into a tighter tier is due no later than its new interval
+                        next_poll[fixture_id] = min(next_poll.get(fixture_id, now), now + interval)
+
+                for fixture_id, future in list(in_flight.items()):
+                    if future.done():
+                        del in_flight[fixture_id]
+
+                # most overdue relative to its interval first, then the shortest interval,
+                # so fixtures near the off win when the budget is short
+                due = sorted(((now - due_at) / -intervals[fixture_id], intervals[fixture_id], fixture_id)
+                             for fixture_id, due_at in next_poll.items() if due_at <= now and fixture_id not in in_flight)
+                for _, _, fixture_id in due:
+                    if len(in_flight) >= num_workers or not budget.try_acquire():
+                        break
+                    next_poll[fixture_id] = now + intervals[fixture_id]
+                    in_flight[fixture_id] = executor.submit(poll_fixture, first_api, fixture_id)
+            except Exception as e:
+                logger_1st.error(f'run_race_poller(): {e}')
+                logger_1st.error(traceback.format_exc())
+                refreshed_at = None
+                time.sleep(RACE_POLL_REFRESH_INTERVAL)
+            time.sleep(1)
@@ -0,0 +1,377 @@
+'''
+replay archived 1st payloads through the processors and uploaders, e.g. after a processing bug was fixed.
+
+    python replay.py --since 2025-06-07 --until 2025-06-08T12:00 [--subdir 1st/unprocessed ...] [--local DIR]
+                     [--workers 8] [--checkpoint replay.checkpoint.json] [--dry-run]
+
+reads both archive layouts under each subdir, for every day in the range:
+    <subdir>/YYYYMMDD-HHMMSS-mmm*.json[.gz|.zst]     one payload per object (the old per-message uploads, claim-check prefix)
+    <subdir>/dt=YYYY-MM-DD/*.ndjson.gz               archiver parts, one record per line (database/archive.py)
+
+objects are read in timestamp order and their records merged by record timestamp across objects and subdirs
+(a part holds records up to REPLAY_REORDER_SECONDS older than its name), then routed by fixture id to a fixed worker,
+so each fixture is replayed in timestamp order while different fixtures run in parallel.
+the checkpoint lists the objects that were fully replayed, rerunning the same command resumes after them.
+objects with a failed record or unreadable line are left out of it, a rerun replays them again.
+with --dry-run payloads are read and processed but nothing is written, tpd ids are not resolved.
+'''
+import os
+import sys
+import json
+import time
+import heapq
+import itertools
+import base64
+import argparse
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from database.archive import S3Backend, LocalBackend, ARCHIVE_BUCKET, ARCHIVE_PART_MAX_SECONDS
+from database.claim_check import load_payload
+from process.fixture_push import process_fixture_from_push
+from process.fixture_pull import process_fixture_from_pull
+from upload.fixture_push import bulk_upload_fixtures_from_push
+from upload.fixture_pull import bulk_upload_fixtures_from_pull
+from upload.price_history import bulk_insert_price_history_data
+from upload.race_status_history import bulk_insert_race_status_history_data
+from upload.jockey import bulk_insert_jockey_data
+from upload.trainer import bulk_insert_trainer_data
+from upload.owner import bulk_insert_owner_data
+from utils import fast_json
+from utils.compression import decompress, detect_encoding
+from utils.sqs_message import read_message_payload
+from utils.worker_pool import KeyedWorkerPool
+from utils.logger import logger_1st
+
+
+REPLAY_PREFETCH = int(os.environ.get('REPLAY_PREFETCH', 16))
+REPLAY_CHECKPOINT_INTERVAL = float(os.environ.get('REPLAY_CHECKPOINT_INTERVAL', 10))
+# how much older than its object timestamp a record can be, at least the archiver's part interval
+REPLAY_REORDER_SECONDS = float(os.environ.get('REPLAY_REORDER_SECONDS', 2 * ARCHIVE_PART_MAX_SECONDS))
+OBJECT_TIMESTAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+
+def parse_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def get_object_timestamp(key: str) -> datetime | None:
+    try:
+        return datetime.strptime(os.path.basename(key)[:15], OBJECT_TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def list_objects(backend, subdirs: list[str], since: datetime, until: datetime) -> list[tuple[datetime, str]]:
+    '''
+    (timestamp, key) of the archived objects in [since, until], oldest first.
+    archiver parts are named after the time they were written, so parts up to one part interval past until are kept,
+    their records are filtered one by one.
+    '''
+    objects = []
+    day = since.date()
+    while day <= until.date() + timedelta(days=1):
+        for subdir in subdirs:
+            for key in backend.list(f'{subdir}/{day.strftime("%Y%m%d")}') + backend.list(f'{subdir}/dt={day.isoformat()}/'):
+                timestamp = get_object_timestamp(key)
+                if timestamp is None:
+                    continue
+                if key.endswith('.ndjson.gz'):
+                    if since <= timestamp <= until + timedelta(days=1):
+                        objects.append((timestamp, key))
+                elif since <= timestamp <= until:
+                    objects.append((timestamp, key))
+        day += timedelta(days=1)
+    return sorted(set(objects))
+
+
+def load_json_payload(payload: bytes):
+    encoding = detect_encoding(payload)
+    if encoding is None and not payload.lstrip().startswith(b'{'):
+        # unprocessed archives of compressed messages may hold the base64 sqs body
+        payload = base64.b64decode(payload)
+        encoding = detect_encoding(payload)
+    return fast_json.loads(decompress(payload, encoding))
+
+
+def read_records(backend, key: str, object_timestamp: datetime, since: datetime, until: datetime) -> tuple[list[dict], list[dict]]:
+    '''
+    replay records of one archived object: {'key', 'index', 'timestamp', 'source', 'data'},
+    and {'key', 'index', 'error'} for each line that could not be read; the other lines are still returned.
+    '''
+    raw = backend.read(key)
+    if not key.endswith('.ndjson.gz'):
+        return [{'key': key, 'index': 0, 'timestamp': object_timestamp, 'source': None, 'data': load_json_payload(raw)}], []
+
+    records = []
+    errors = []
+    for index, line in enumerate(decompress(raw, 'gzip').splitlines()):
+        if not line.strip():
+            continue
+        try:
+            record = read_record(line)
+        except Exception as e:
+            logger_1st.error(f'replay: {key}#{index}: {e}')
+            errors.append({'key': key, 'index': index, 'error': str(e)})
+            continue
+        if record is None or not since <= record['timestamp'] <= until:
+            continue
+        records.append({'key': key, 'index': index, **record})
+    return records, errors
+
+
+def read_record(line: bytes) -> dict | None:
+    '''
+    {'timestamp', 'source', 'data'} of one archiver line, none for a record without a payload.
+    '''
+    record = fast_json.loads(line)
+    if record.get('sent_timestamp'):
+        timestamp = datetime.fromtimestamp(record['sent_timestamp'] / 1000, tz=timezone.utc)
+    else:
+        timestamp = datetime.fromisoformat(record['archived_at'])
+
+    if 'data' in record:
+        data = record['data']
+    elif 'data_base64' in record:
+        data = load_json_payload(base64.b64decode(record['data_base64']))
+    elif 'claim_check' in record:
+        pointer = record['claim_check']
+        data = fast_json.loads(decompress(load_payload(pointer), pointer.get('content_encoding')))
+    elif 'body' in record:
+        payload, content_encoding = read_message_payload({'Body': record['body'], 'MessageAttributes': record.get('attributes', {})})
+        data = fast_json.loads(decompress(payload, content_encoding))
+    else:
+        return None
+    return {'timestamp': timestamp, 'source': record.get('source'), 'data': data}
+
+
+def get_payload_source(record: dict) -> str | None:
+    '''
+    push, pull or horse. archiver records carry it, single-object archives are told apart by their shape.
+    '''
+    data = record['data']
+    if not isinstance(data, dict):
+        return None
+    if record['source']:
+        return record['source']
+    if 'horse_id' in data:
+        return 'horse'
+    if 'fixtures' not in data:
+        return None
+    for fixture in data['fixtures']:
+        for race in fixture.get('races', []):
+            if 'statusHistory' in race or 'offTime' in race or any('showPrices' in entry for entry in race.get('entries', [])):
+                return 'push'
+    return 'pull'
+
+
+def get_fixture_key(data: dict) -> str | None:
+    try:
+        fixture_ids = [str(fixture.get('header', {}).get('id')) for fixture in data.get('fixtures', [])]
+        return min(fixture_ids) if fixture_ids else None
+    except Exception:
+        return None
+
+
+class Replay:
+    def __init__(self, backend, subdirs: list[str], since: datetime, until: datetime, workers: int = 4, checkpoint_path: str | None = None, dry_run: bool = False):
+        self.backend = backend
+        self.subdirs = subdirs
+        self.since = since
+        self.until = until
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.dry_run = dry_run
+        self.done_keys = self.load_checkpoint()
+        self.pending = {}  # key -> records not handled yet
+        self.failed_keys = set()  # objects with a failure, never checkpointed as done
+        self.lock = threading.Lock()
+        self.stats = {'objects': 0, 'replayed': 0, 'failed': 0, 'skipped': 0}
+        self.failures = []
+        self.started_at = None
+        self.last_report = None
+
+    def load_checkpoint(self) -> set:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path) as f:
+            return set(json.load(f).get('done', []))
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path or self.dry_run:
+            return
+        with self.lock:
+            done = sorted(self.done_keys)
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'since': self.since.isoformat(), 'until': self.until.isoformat(), 'done': done}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def run(self) -> dict:
+        objects = [(timestamp, key) for timestamp, key in list_objects(self.backend, self.subdirs, self.since, self.until) if key not in self.done_keys]
+        logger_1st.info(f'replay: {len(objects)} objects to replay, {len(self.done_keys)} done before | dry run: {self.dry_run}')
+        self.started_at = self.last_report = time.monotonic()
+
+        pool = KeyedWorkerPool(self.handle_records, num_workers=self.workers, max_in_flight=self.workers * 50, batch_size=1, name='replay').start()
+        reorder = []  # heap of (record timestamp, sequence, record) read but not submitted yet
+        sequence = itertools.count()
+        reorder_window = timedelta(seconds=REPLAY_REORDER_SECONDS)
+        try:
+            with ThreadPoolExecutor(max_workers=REPLAY_PREFETCH, thread_name_prefix='replay-read') as executor:
+                prefetched = deque()
+                objects = iter(objects)
+                while True:
+                    while len(prefetched) < REPLAY_PREFETCH:
+                        item = next(objects, None)
+                        if item is None:
+                            break
+                        timestamp, key = item
+                        prefetched.append((timestamp, key, executor.submit(read_records, self.backend, key, timestamp, self.since, self.until)))
+                    if not prefetched:
+                        break
+                    timestamp, key, future = prefetched.popleft()
+                    for record in self.read_object(key, future):
+                        heapq.heappush(reorder, (record['timestamp'], next(sequence), record))
+                    # objects still to come are not older than this one, so neither are their records minus the window
+                    while reorder and reorder[0][0] < timestamp - reorder_window:
+                        self.submit_record(pool, heapq.heappop(reorder)[2])
+                    self.report()
+            while reorder:
+                self.submit_record(pool, heapq.heappop(reorder)[2])
+        finally:
+            pool.stop()
+            self.save_checkpoint()
+        self.report(final=True)
+        return self.stats
+
+    def read_object(self, key: str, future) -> list[dict]:
+        '''
+        the records of one prefetched object, counted as pending until each was handled.
+        '''
+        try:
+            records, errors = future.result()
+        except Exception as e:
+            logger_1st.error(f'replay: {key}: {e}')
+            logger_1st.error(traceback.format_exc())
+            records, errors = [], [{'key': key, 'index': None, 'error': str(e)}]
+
+        with self.lock:
+            self.stats['objects'] += 1
+            self.stats['failed'] += len(errors)
+            self.failures.extend(errors)
+            if errors:
+                self.failed_keys.add(key)
+            if not records:
+                if not errors:
+                    self.done_keys.add(key)
+                return []
+            self.pending[key] = len(records)
+        return records
+
+    def submit_record(self, pool: KeyedWorkerPool, record: dict):
+        pool.submit(get_fixture_key(record['data']) if isinstance(record['data'], dict) else None, record)
+
+    def handle_records(self, records: list[dict]):
+        for record in records:
+            try:
+                outcome = self.replay_record(record)
+            except Exception as e:
+                logger_1st.error(f'replay: {record["key"]}#{record["index"]}: {e}')
+                logger_1st.error(traceback.format_exc())
+                outcome = 'failed'
+                error = str(e)
+            else:
+                error = None if outcome != 'failed' else 'write failed'
+
+            with self.lock:
+                self.stats[outcome] += 1
+                if outcome == 'failed':
+                    self.failures.append({'key': record['key'], 'index': record['index'], 'error': error})
+                    self.failed_keys.add(record['key'])
+                self.pending[record['key']] -= 1
+                if not self.pending[record['key']]:
+                    del self.pending[record['key']]
+                    if record['key'] not in self.failed_keys:
+                        self.done_keys.add(record['key'])
+
+    def replay_record(self, record: dict) -> str:
+        source = get_payload_source(record)
+        if source == 'push':
+            fixture_data = process_fixture_from_push(record['data'], use_watermarks=False, resolve_ids=not self.dry_run)
+            if self.dry_run:
+                return 'replayed'
+            if fixture_data['fixtures'] and bulk_upload_fixtures_from_push(fixture_data['fixtures'], overwrite=True, skip_unchanged=False) is None:
+                return 'failed'
+            if fixture_data['race_status_history_dict'] and not bulk_insert_race_status_history_data(fixture_data['race_status_history_dict']):
+                return 'failed'
+            if fixture_data['price_history_dict'] and not bulk_insert_price_history_data(fixture_data['price_history_dict']):
+                return 'failed'
+            return 'replayed'
+
+        if source == 'pull':
+            fixture_result = process_fixture_from_pull(record['data'], resolve_ids=not self.dry_run)
+            if self.dry_run:
+                return 'replayed'
+            if fixture_result['fixtures'] and bulk_upload_fixtures_from_pull(fixture_result['fixtures'], overwrite=True) is None:
+                return 'failed'
+            for upload, rows in [
+                (bulk_insert_jockey_data, fixture_result['jockey_dict']),
+                (bulk_insert_trainer_data, fixture_result['trainer_dict']),
+                (bulk_insert_owner_data, fixture_result['owner_dict']),
+            ]:
+                if rows and not upload(rows):
+                    return 'failed'
+            return 'replayed'
+
+        # horse payloads would need a fresh api fetch, they are left to the horse enrichment
+        return 'skipped'
+
+    def report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.last_report < REPLAY_CHECKPOINT_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started_at, 1e-9)
+        with self.lock:
+            stats = dict(self.stats)
+        logger_1st.info(f'replay: {stats} | {stats["replayed"] / elapsed:.1f} msgs/sec | {elapsed:.0f} s')
+        if not final:
+            self.save_checkpoint()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='replay archived 1st payloads')
+    arg_parser.add_argument('--since', required=True, type=parse_datetime, help='iso date or datetime, utc unless an offset is given')
+    arg_parser.add_argument('--until', type=parse_datetime, default=None, help='defaults to now')
+    arg_parser.add_argument('--subdir', action='append', dest='subdirs', help='archive subdir, repeatable (default: 1st/unprocessed)')
+    arg_parser.add_argument('--bucket', default=ARCHIVE_BUCKET)
+    arg_parser.add_argument('--local', help='read a local archive directory instead of s3')
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--checkpoint', default='replay.checkpoint.json')
+    arg_parser.add_argument('--failures', help='write failed records as ndjson to this file')
+    arg_parser.add_argument('--dry-run', action='store_true')
+    args = arg_parser.parse_args()
+
+    backend = LocalBackend(args.local) if args.local else S3Backend(args.bucket)
+    replay = Replay(
+        backend,
+        subdirs=args.subdirs or ['1st/unprocessed'],
+        since=args.since,
+        until=args.until or datetime.now(timezone.utc),
+        workers=args.workers,
+        checkpoint_path=args.checkpoint,
+        dry_run=args.dry_run,
+    )
+    stats = replay.run()
+    if args.failures and replay.failures:
+        with open(args.failures, 'w') as f:
+            for failure in replay.failures:
+                f.write(json.dumps(failure) + '\n')
+    sys.exit(1 if stats['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,162 +1,141 @@
+import os
+import json
 import traceback
-from database.general import session_scope, FirstFixture, FirstRace, FirstEntry
+from typing import Iterable
+from database.general import session_scope
+from database.archive import archiver, make_record
+from database.bulk import bulk_upsert_fixtures, split_fixture_rows, format_upsert_counts
+from database.fingerprint import fixture_fingerprints
+from process.fixture_pull import PullDimensions, process_fixture_from_pull, iter_fixtures_from_pull
+from upload.jockey import bulk_insert_jockey_data
+from upload.trainer import bulk_insert_trainer_data
+from upload.owner import bulk_insert_owner_data
+from upload.horse import enqueue_horse_data
+from utils import fast_json
 from utils.logger import logger_1st
 
 
+# write pulls one fixture at a time instead of holding the whole day, see ingest_fixture_pull()
+PULL_STREAMING = os.environ.get('PULL_STREAMING', '1') == '1'
+FIXTURE_COLUMNS = [
+    'fixture_id', 'fixture_date', 'first_post_time', 'race_count', 'temperature_fahrenheit',
+    'temperature_celsius', 'track_id', 'tpd_meeting_id',
+]
+RACE_COLUMNS = [
+    'race_id', 'fixture_id', 'track_type', 'race_number', 'runner_count', 'post_time',
+    'estimated_post_time', 'race_status', 'isdst', 'timezone_offset', 'weather', 'going', 'surface_id',
+    'grade', 'distance', 'distance_unit', 'distance_text', 'race_breed', 'racetype_id', 'racetype_subtype',
+    'sex_restriction_id', 'age_restriction_id', 'purse', 'purse_ranks', 'purse_unit', 'race_class',
+    'race_name', 'race_comment', 'race_tip', 'tpd_race_id',
+]
+ENTRY_COLUMNS = [
+    'entry_id', 'race_id', 'start_number', 'program_number', 'start_position', 'coupled_indicator',
+    'decoupled_number', 'scratch_indicator', 'age', 'weight', 'weight_unit', 'horse_id', 'jockey_id',
+    'trainer_id', 'owner_id', 'breeder_name', 'runner_tip', 'tpd_runner_id',
+]
 
-def upload_fixture_from_pull(fixture: dict, overwrite: bool = False):
+
+
+def bulk_upload_fixtures_from_pull(fixtures: list, overwrite: bool = False) -> dict | None:
     '''
-    upload fixture data received from pull method, which we pull from 1st's API.
+    upload every fixture, race and entry of a pull in a single transaction,
+    with one multi-row INSERT ... ON DUPLICATE KEY UPDATE per table.
+    the push path's fingerprints of the written rows are dropped, their columns overlap and may have changed.
     '''
+    if not fixtures:
+        return None
+
     try:
-        with session_scope() as session:
-            existing_fixture = session.query(FirstFixture).filter(FirstFixture.fixture_id == fixture['fixture_id']).first()
-            if existing_fixture:
-                if overwrite:
-                    existing_fixture.fixture_date = fixture.get('fixture_date')
-                    existing_fixture.first_post_time = fixture.get('first_post_time')
-                    existing_fixture.race_count = fixture.get('race_count')
-                    existing_fixture.temperature_fahrenheit = fixture.get('temperature_fahrenheit')
-                    existing_fixture.temperature_celsius = fixture.get('temperature_celsius')
-                    existing_fixture.track_id = fixture.get('track_id')
-                    existing_fixture.tpd_meeting_id = fixture.get('tpd_meeting_id')
-            else:
-                new_fixture = FirstFixture(
-                    fixture_id = fixture.get('fixture_id'),
-                    fixture_date = fixture.get('fixture_date'),
-                    first_post_time = fixture.get('first_post_time'),
-                    race_count = fixture.get('race_count'),
-                    temperature_fahrenheit = fixture.get('temperature_fahrenheit'),
-                    temperature_celsius = fixture.get('temperature_celsius'),
-                    track_id = fixture.get('track_id'),
-                    tpd_meeting_id = fixture.get('tpd_meeting_id'),
-                )
-                session.add(new_fixture)
+        with session_scope(raise_error=True) as session:
+            counts = bulk_upsert_fixtures(session, fixtures, FIXTURE_COLUMNS, RACE_COLUMNS, ENTRY_COLUMNS, overwrite=overwrite)
+        fixture_rows, race_rows, entry_rows = split_fixture_rows(fixtures)
+        fixture_fingerprints.forget('fixture', [row['fixture_id'] for row in fixture_rows])
+        fixture_fingerprints.forget('race', [row['race_id'] for row in race_rows])
+        fixture_fingerprints.forget('entry', [row['entry_id'] for row in entry_rows])
+        logger_1st.info(f'bulk_upload_fixtures_from_pull(): {format_upsert_counts(counts)}')
+        return counts
+    except Exception as e:
+        logger_1st.error(f'bulk_upload_fixtures_from_pull(): fixture_ids: {[fixture.get("fixture_id") for fixture in fixtures]}')
+        logger_1st.error(traceback.format_exc())
+        return None
 
-        races = fixture.get('race_data', [])
-        for race in races:
-            with session_scope() as session:
-                existing_race = session.query(FirstRace).filter(FirstRace.race_id == race['race_id']).first()
-                if existing_race:
-                    if overwrite:
-                        existing_race.fixture_id = race.get('fixture_id')
-                        existing_race.track_type = race.get('track_type')
-                        existing_race.race_number = race.get('race_number')
-                        existing_race.runner_count = race.get('runner_count')
-                        existing_race.post_time = race.get('post_time')
-                        existing_race.estimated_post_time = race.get('estimated_post_time')
-                        existing_race.race_status = race.get('race_status')
-                        existing_race.isdst = race.get('isdst')
-                        existing_race.timezone_offset = race.get('timezone_offset')
-                        existing_race.weather = race.get('weather')
-                        existing_race.going = race.get('going')
-                        existing_race.surface_id = race.get('surface_id')
-                        existing_race.grade = race.get('grade')
-                        existing_race.distance = race.get('distance')
-                        existing_race.distance_unit = race.get('distance_unit')
-                        existing_race.distance_text = race.get('distance_text')
-                        existing_race.race_breed = race.get('race_breed')
-                        existing_race.racetype_id = race.get('racetype_id')
-                        existing_race.racetype_subtype = race.get('racetype_subtype')
-                        existing_race.sex_restriction_id = race.get('sex_restriction_id')
-                        existing_race.age_restriction_id = race.get('age_restriction_id')
-                        existing_race.purse = race.get('purse')
-                        existing_race.purse_ranks = race.get('purse_ranks')
-                        existing_race.purse_unit = race.get('purse_unit')
-                        existing_race.race_class = race.get('race_class'),
-                        existing_race.race_name = race.get('race_name')
-                        existing_race.race_comment = race.get('race_comment')
-                        existing_race.race_tip = race.get('race_tip')
-                        existing_race.tpd_race_id = race.get('tpd_race_id')
-                else:
-                    new_race = FirstRace(
-                        race_id = race.get('race_id'),
-                        fixture_id = race.get('fixture_id'),
-                        track_type = race.get('track_type'),
-                        race_number = race.get('race_number'),
-                        runner_count = race.get('runner_count'),
-                        post_time = race.get('post_time'),
-                        estimated_post_time = race.get('estimated_post_time'),
-                        race_status = race.get('race_status'),
-                        isdst = race.get('isdst'),
-                        timezone_offset = race.get('timezone_offset'),
-                        weather = race.get('weather'),
-                        going = race.get('going'),
-                        surface_id = race.get('surface_id'),
-                        grade = race.get('grade'),
-                        distance = race.get('distance'),
-                        distance_unit = race.get('distance_unit'),
-                        distance_text = race.get('distance_text'),
-                        race_breed = race.get('race_breed'),
-                        racetype_id = race.get('racetype_id'),
-                        racetype_subtype = race.get('racetype_subtype'),
-                        sex_restriction_id = race.get('sex_restriction_id'),
-                        age_restriction_id = race.get('age_restriction_id'),
-                        purse = race.get('purse'),
-                        purse_ranks = race.get('purse_ranks'),
-                        purse_unit = race.get('purse_unit'),
-                        race_class = race.get('race_class'),
-                        race_name = race.get('race_name'),
-                        race_comment = race.get('race_comment'),
-                        race_tip = race.get('race_tip'),
-                        tpd_race_id = race.get('tpd_race_id'),
-                    )
-                    session.add(new_race)
 
-        
-            entries = race.get('entry_data', [])
-            for entry in entries:
-                with session_scope() as session:
-                    existing_entry = session.query(FirstEntry).filter(FirstEntry.entry_id == entry['entry_id']).first()
-                    if existing_entry:
-                        if overwrite:
-                            existing_entry.race_id = entry.get('race_id')
-                            existing_entry.start_number = entry.get('start_number')
-                            existing_entry.program_number = entry.get('program_number')
-                            existing_entry.start_position = entry.get('start_position')
-                            existing_entry.coupled_indicator = entry.get('coupled_indicator')
-                            existing_entry.decoupled_number = entry.get('decoupled_number')
-                            existing_entry.scratch_indicator = entry.get('scratch_indicator')
-                            existing_entry.age = entry.get('age')
-                            existing_entry.weight = entry.get('weight')
-                            existing_entry.weight_unit = entry.get('weight_unit')
-                            existing_entry.horse_id = entry.get('horse_id')
-                            existing_entry.jockey_id = entry.get('jockey_id')
-                            existing_entry.trainer_id = entry.get('trainer_id')
-                            existing_entry.owner_id = entry.get('owner_id')
-                            existing_entry.breeder_name = entry.get('breeder_name')
-                            existing_entry.runner_tip = entry.get('runner_tip')
-                            existing_entry.tpd_runner_id = entry.get('tpd_runner_id')
-                    else:
-                        new_entry = FirstEntry(
-                            entry_id = entry.get('entry_id'),
-                            race_id = entry.get('race_id'),
-                            start_number = entry.get('start_number'),
-                            program_number = entry.get('program_number'),
-                            start_position = entry.get('start_position'),
-                            coupled_indicator = entry.get('coupled_indicator'),
-                            decoupled_number = entry.get('decoupled_number'),
-                            scratch_indicator = entry.get('scratch_indicator'),
-                            age = entry.get('age'),
-                            weight = entry.get('weight'),
-                            weight_unit = entry.get('weight_unit'),
-                            horse_id = entry.get('horse_id'),
-                            jockey_id = entry.get('jockey_id'),
-                            trainer_id = entry.get('trainer_id'),
-                            owner_id = entry.get('owner_id'),
-                            breeder_name = entry.get('breeder_name'),
-                            runner_tip = entry.get('runner_tip'),
-                            tpd_runner_id = entry.get('tpd_runner_id'),
-                        )
-                        session.add(new_entry)
+def drain(items: list):
+    '''
+    yield the items of a list in order while removing them from it, so each one can be freed once processed.
+    '''
+    items.reverse()
+    while items:
+        yield items.pop()
 
+
+def ingest_fixture_pull(fixture_data: dict | bytes, stream: bool = PULL_STREAMING, **archive_fields) -> bool:
+    '''
+    process a fofixtures payload and write it: fixtures, races and entries, jockeys, trainers and owners,
+    new horses are queued for enrichment. written payloads are archived as processed, failed ones as unprocessed.
+    with stream, fixtures are processed, written and archived one at a time, so only one fixture is held at once:
+    a raw body (FirstAPI.get_fofixtures_body()) is parsed incrementally, a parsed payload has its
+    fixture_data['fixtures'] emptied on the way. otherwise the whole payload is written in one transaction.
+    returns whether everything was written.
+    '''
+    if stream and isinstance(fixture_data, bytes):
+        try:
+            return ingest_fixtures(fast_json.iter_items(fixture_data, 'fixtures.item'), **archive_fields)
+        except Exception as e:
+            # the body stopped parsing part way, the fixtures before that are written and archived already
+            logger_1st.error(f'ingest_fixture_pull(): {archive_fields}: {e}')
+            logger_1st.error(traceback.format_exc())
+            archiver.append('1st/unprocessed', make_record('pull', fixture_data, verified=False, **archive_fields))
+            return False
+    if stream:
+        return ingest_fixtures(drain(fixture_data.get('fixtures', [])), **archive_fields)
+
+    raw_data = fixture_data if isinstance(fixture_data, bytes) else json.dumps(fixture_data)
+    try:
+        if isinstance(fixture_data, bytes):
+            fixture_data = fast_json.loads(fixture_data)
+        fixture_result = process_fixture_from_pull(fixture_data)
+        fixtures = fixture_result['fixtures']
+        logger_1st.info(f'Uploading fixture: {len(fixtures)}')
+        if fixtures and bulk_upload_fixtures_from_pull(fixtures, overwrite=True) is None:
+            raise RuntimeError('fixtures were not written')
+        bulk_insert_jockey_data(fixture_result['jockey_dict'])
+        bulk_insert_trainer_data(fixture_result['trainer_dict'])
+        bulk_insert_owner_data(fixture_result['owner_dict'])
+        enqueue_horse_data(fixture_result['horse_dict'])
+        archiver.append('1st/processed', make_record('pull', raw_data, **archive_fields))
         return True
     except Exception as e:
-        logger_1st.error(f'upload_fixture_from_pull(): fixture_id: {fixture.get("fixture_id")}')
+        logger_1st.error(f'ingest_fixture_pull(): {archive_fields}: {e}')
         logger_1st.error(traceback.format_exc())
+        archiver.append('1st/unprocessed', make_record('pull', raw_data, verified=False, **archive_fields))
         return False
-    
-
-
 
 
+def ingest_fixtures(fixtures: Iterable[dict], **archive_fields) -> bool:
+    '''
+    streaming ingest_fixture_pull() over raw fixtures, see iter_fixtures_from_pull().
+    each fixture is written in its own transaction and archived as its own {"fixtures": [fixture]} record,
+    the dimensions are written once at the end.
+    '''
+    dimensions = PullDimensions()
+    written = 0
+    failed = 0
+    try:
+        for fixture, processed_fixture in iter_fixtures_from_pull(fixtures, dimensions):
+            record_fields = {**archive_fields, 'fixture_id': fixture.get('header', {}).get('id')}
+            if processed_fixture is not None and bulk_upload_fixtures_from_pull([processed_fixture], overwrite=True) is not None:
+                written += 1
+                archiver.append('1st/processed', make_record('pull', json.dumps({'fixtures': [fixture]}), **record_fields))
+            else:
+                failed += 1
+                archiver.append('1st/unprocessed', make_record('pull', json.dumps({'fixtures': [fixture]}), **record_fields))
+    finally:
+        # also when fixtures stops part way, for the fixtures already written
+        dimension_dicts = dimensions.get_dicts()
+        bulk_insert_jockey_data(dimension_dicts['jockey_dict'])
+        bulk_insert_trainer_data(dimension_dicts['trainer_dict'])
+        bulk_insert_owner_data(dimension_dicts['owner_dict'])
+        enqueue_horse_data(dimension_dicts['horse_dict'])
+    logger_1st.info(f'ingest_fixtures(): {archive_fields} | written {written}, failed {failed}')
+    return failed == 0
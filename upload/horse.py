@@ -1,13 +1,31 @@
-import traceback
-import time
+import os
 import json
-from database.general import session_scope, FirstHorse
+import time
+import random
+import traceback
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, text
+from database.general import session_scope, FirstHorse, FirstHorsePending
+from database.bulk import get_existing_keys, bulk_insert_new
 from first import FirstAPI
 from process.horse import process_horse_data
-from database.s3 import upload_to_s3
+from database.archive import archiver, make_record
+from utils.rate_limit import TokenBucket
+from utils.http_cache import get_response_cache
 from utils.logger import logger_1st
 
 
+HORSE_WORKERS = int(os.environ.get('HORSE_WORKERS', 4))
+HORSE_BATCH_SIZE = int(os.environ.get('HORSE_BATCH_SIZE', 50))
+# shared by all workers, keep it within 1st's quota for the horse endpoint
+HORSE_RATE_PER_SECOND = float(os.environ.get('HORSE_RATE_PER_SECOND', 1))
+HORSE_RATE_BURST = float(os.environ.get('HORSE_RATE_BURST', 1))
+HORSE_MAX_ATTEMPTS = int(os.environ.get('HORSE_MAX_ATTEMPTS', 5))
+HORSE_RETRY_BASE = float(os.environ.get('HORSE_RETRY_BASE', 60))
+HORSE_RETRY_MAX = float(os.environ.get('HORSE_RETRY_MAX', 6 * 60 * 60))
+HORSE_POLL_INTERVAL = float(os.environ.get('HORSE_POLL_INTERVAL', 30))
+
 
 def upload_horse_data(horse: dict, overwrite: bool = False):
     '''
@@ -61,67 +79,133 @@ def upload_horse_data(horse: dict, overwrite: bool = False):
         return False
     
 
-def bulk_insert_horse_data(horse_dict: dict):
+def enqueue_horse_data(horse_dict: dict) -> dict | bool:
     '''
-    bulk insert horse data received from pull method, which we pull from 1st's API.
+    queue the horses of horse_dict that are not in first_horse yet for enrichment, see run_horse_enrichment().
+    returns queued/skipped counts, skipped are horses already stored or already queued.
     '''
     if not horse_dict:
         return False
-    
+
     try:
-        horse_id_list = list(horse_dict.keys())
-        if not horse_id_list:
-            return False
-        
-        with session_scope() as session:
-            existing_horse_id_list = session.query(FirstHorse.horse_id).all()
-            existing_horse_id_list = [horse_id[0] for horse_id in existing_horse_id_list]
-            new_horse_id_list = [horse_id for horse_id in horse_id_list if horse_id not in existing_horse_id_list]
+        with session_scope(raise_error=True) as session:
+            existing_horse_ids = get_existing_keys(session, FirstHorse, horse_dict.keys())
+            new_horses = {horse_id: {'horse_id': horse_id} for horse_id in horse_dict if horse_id not in existing_horse_ids}
+            counts = bulk_insert_new(session, FirstHorsePending, new_horses)
+        counts = {'queued': counts['inserted'], 'skipped': counts['skipped'] + len(existing_horse_ids)}
+        logger_1st.info(f'enqueue_horse_data(): queued {counts["queued"]}, skipped {counts["skipped"]}')
+        return counts
+    except Exception as e:
+        logger_1st.error(f'enqueue_horse_data(): {e}')
+        logger_1st.error(traceback.format_exc())
+        return False
 
-        logger_1st.info(f'new horse to process: {new_horse_id_list}')
-        if not new_horse_id_list:
-            return True
 
-        first_api = FirstAPI()
-        horse_data_to_insert = []
-        for horse_id in new_horse_id_list:
-            try:
-                horse_data = first_api.get_horses(horse_id)
-                if not horse_data:
-                    logger_1st.warning(f'bulk_insert_horse_data(): No data returned for horse {horse_id}')
-                    continue
-                    
-                horse_data_processed = process_horse_data(horse_data)
-                time.sleep(1)
-                if not horse_data_processed:
-                    logger_1st.warning(f'bulk_insert_horse_data(): Failed to process data for horse {horse_id}')
-                    continue
-                horse_data_to_insert.append(horse_data_processed)
-                logger_1st.info(f'horse_id: {horse_id} processed')
-                upload_to_s3(file_content=json.dumps(horse_data), s3_subdir='1st/processed')
-            except Exception as e:
-                logger_1st.error(f'bulk_insert_horse_data(): Error processing horse {horse_id}: {e}')
-                logger_1st.error(traceback.format_exc())
-                try:
-                    upload_to_s3(file_content=json.dumps(horse_data), s3_subdir='1st/unprocessed')
-                except:
-                    logger_1st.error(f'bulk_insert_horse_data(): Failed to upload to S3 for horse {horse_id}')
-                continue
+def get_due_horse_ids(limit: int = HORSE_BATCH_SIZE) -> list[str]:
+    with session_scope(raise_error=True) as session:
+        rows = session.query(FirstHorsePending.horse_id).filter(
+            FirstHorsePending.status == 'pending',
+            FirstHorsePending.next_attempt_at <= func.now(),
+        ).order_by(FirstHorsePending.next_attempt_at).limit(limit)
+        return [horse_id for horse_id, in rows]
 
-        if not horse_data_to_insert:
-            logger_1st.info(f'bulk_insert_horse_data(): No horse data to insert, exiting')
-            return False
 
-        with session_scope() as session:
-            session.bulk_insert_mappings(FirstHorse, horse_data_to_insert)
-            session.commit()
-        logger_1st.info(f'bulk_insert_horse_data(): Inserted {len(horse_data_to_insert)} horses into database')
+def fetch_horse(first_api: FirstAPI, rate_limit: TokenBucket, horse_id: str) -> tuple[str, dict | None, str | None]:
+    '''
+    (horse_id, processed horse, error) for one horse, waiting for the shared rate limit first.
+    '''
+    rate_limit.acquire()
+    horse_data = None
+    try:
+        horse_data = first_api.get_horses(horse_id)
+        if not horse_data:
+            return horse_id, None, 'no data returned'
+        horse_data_processed = process_horse_data(horse_data)
+        if not horse_data_processed:
+            archiver.append('1st/unprocessed', make_record('horse', json.dumps(horse_data), horse_id=horse_id))
+            return horse_id, None, 'failed to process'
+        archiver.append('1st/processed', make_record('horse', json.dumps(horse_data), horse_id=horse_id))
+        return horse_id, horse_data_processed, None
+    except Exception as e:
+        logger_1st.error(f'fetch_horse(): horse_id: {horse_id}: {e}')
+        logger_1st.error(traceback.format_exc())
+        if horse_data:
+            archiver.append('1st/unprocessed', make_record('horse', json.dumps(horse_data), horse_id=horse_id))
+        return horse_id, None, str(e)
 
-        return True
-    
+
+def get_retry_delay(attempts: int) -> int:
+    # exponential backoff with jitter, so horses failing together are not retried together
+    return int(min(HORSE_RETRY_BASE * 2 ** (attempts - 1), HORSE_RETRY_MAX) * random.uniform(0.8, 1.2))
+
+
+def save_horse_results(results: list[tuple[str, dict | None, str | None]]) -> dict:
+    '''
+    one transaction: insert the fetched horses, drop them from the queue and reschedule the failures.
+    '''
+    horses = {horse_id: horse for horse_id, horse, _ in results if horse}
+    failures = {horse_id: error for horse_id, horse, error in results if not horse}
+    with session_scope(raise_error=True) as session:
+        counts = bulk_insert_new(session, FirstHorse, horses)
+        if horses:
+            session.query(FirstHorsePending).filter(FirstHorsePending.horse_id.in_(horses)).delete(synchronize_session=False)
+        counts['failed'] = 0
+        counts['retrying'] = 0
+        for pending_horse in session.query(FirstHorsePending).filter(FirstHorsePending.horse_id.in_(failures)):
+            pending_horse.attempts += 1
+            pending_horse.last_error = failures[pending_horse.horse_id]
+            if pending_horse.attempts >= HORSE_MAX_ATTEMPTS:
+                pending_horse.status = 'failed'
+                counts['failed'] += 1
+            else:
+                pending_horse.next_attempt_at = func.timestampadd(text('SECOND'), get_retry_delay(pending_horse.attempts), func.now())
+                counts['retrying'] += 1
+    return counts
+
+
+def save_horse_batch(results: list[tuple[str, dict | None, str | None]]) -> dict:
+    '''
+    save_horse_results() for the whole batch. if that fails the horses are saved one by one, and a horse that
+    cannot be saved is rescheduled as a failure in its own transaction, so one bad row does not stall the queue.
+    '''
+    try:
+        return save_horse_results(results)
     except Exception as e:
-        logger_1st.error(f'bulk_insert_horse_data(): {e}')
+        logger_1st.error(f'save_horse_batch(): batch of {len(results)} failed, saving one by one: {e}')
         logger_1st.error(traceback.format_exc())
-        return False
-    
-    
\ No newline at end of file
+
+    counts = {'inserted': 0, 'skipped': 0, 'failed': 0, 'retrying': 0}
+    for horse_id, horse, error in results:
+        try:
+            horse_counts = save_horse_results([(horse_id, horse, error)])
+        except Exception as e:
+            logger_1st.error(f'save_horse_batch(): horse_id: {horse_id}: {e}')
+            horse_counts = save_horse_results([(horse_id, None, f'failed to save: {e}')])
+        for key in counts:
+            counts[key] += horse_counts[key]
+    return counts
+
+
+def run_horse_enrichment(num_workers: int = HORSE_WORKERS, batch_size: int = HORSE_BATCH_SIZE):
+    '''
+    work through first_horse_pending forever: fetch due horses concurrently within the shared rate limit
+    and store each batch with save_horse_batch(). runs in its own thread, fixture ingestion only enqueues.
+    '''
+    first_api = FirstAPI(cache=get_response_cache())
+    rate_limit = TokenBucket(HORSE_RATE_PER_SECOND, HORSE_RATE_BURST)
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='horse') as executor:
+        while True:
+            try:
+                horse_ids = get_due_horse_ids(batch_size)
+                if not horse_ids:
+                    time.sleep(HORSE_POLL_INTERVAL)
+                    continue
+                started_at = time.monotonic()
+                results = list(executor.map(partial(fetch_horse, first_api, rate_limit), horse_ids))
+                counts = save_horse_batch(results)
+                logger_1st.info(f'run_horse_enrichment(): {len(horse_ids)} horses in {time.monotonic() - started_at:.1f} s | '
+                                f'inserted {counts["inserted"]}, skipped {counts["skipped"]}, retrying {counts["retrying"]}, failed {counts["failed"]}')
+            except Exception as e:
+                logger_1st.error(f'run_horse_enrichment(): {e}')
+                logger_1st.error(traceback.format_exc())
+                time.sleep(HORSE_POLL_INTERVAL)
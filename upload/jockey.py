@@ -1,5 +1,6 @@
 import traceback
 from database.general import session_scope, FirstJockey
+from database.bulk import bulk_insert_new
 from utils.logger import logger_1st
 
 
@@ -36,29 +37,17 @@ def upload_jockey_data(jockey: dict, overwrite: bool = False):
 def bulk_insert_jockey_data(jockey_dict: dict):
     '''
     bulk insert jockey data received from pull method, which we pull from 1st's API.
+    returns inserted/skipped counts.
     '''
     if not jockey_dict:
         return False
-    
+
     try:
-        jockey_id_list = list(jockey_dict.keys())
-        if not jockey_id_list:
-            return False
-        
-        with session_scope() as session:
-            existing_jockey_id_list = session.query(FirstJockey.jockey_id).all()
-            existing_jockey_id_list = [jockey_id[0] for jockey_id in existing_jockey_id_list]
-            new_jockey_id_list = [jockey_id for jockey_id in jockey_id_list if jockey_id not in existing_jockey_id_list]
-            
-        jockey_data_to_insert = [jockey_dict[jockey_id] for jockey_id in new_jockey_id_list]
-        if not jockey_data_to_insert:
-            return False
-            
-        with session_scope() as session:
-            session.bulk_insert_mappings(FirstJockey, jockey_data_to_insert)
-            session.commit()
-        return True
-    
+        with session_scope(raise_error=True) as session:
+            counts = bulk_insert_new(session, FirstJockey, jockey_dict)
+        logger_1st.info(f'bulk_insert_jockey_data(): inserted {counts["inserted"]}, skipped {counts["skipped"]}')
+        return counts
+
     except Exception as e:
         logger_1st.error(f'bulk_insert_jockey_data(): {e}')
         logger_1st.error(traceback.format_exc())
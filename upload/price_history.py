@@ -1,5 +1,6 @@
 import traceback
 from database.general import session_scope, FirstPriceHistory
+from database.bulk import bulk_insert_new
 from utils.logger import logger_1st
 
 
@@ -41,29 +42,17 @@ def upload_price_history_data(price_history: dict, overwrite: bool = False):
 def bulk_insert_price_history_data(price_history_dict: dict):
     '''
     bulk insert price history data received from pull method, which we pull from 1st's API.
+    returns inserted/skipped counts.
     '''
     if not price_history_dict:
         return False
-    
+
     try:
-        price_history_id_list = list(price_history_dict.keys())
-        if not price_history_id_list:
-            return False
-        
-        with session_scope() as session:
-            existing_price_history_id_list = session.query(FirstPriceHistory.price_id).all()
-            existing_price_history_id_list = [price_history_id[0] for price_history_id in existing_price_history_id_list]
-            new_price_history_id_list = [price_history_id for price_history_id in price_history_id_list if price_history_id not in existing_price_history_id_list]
-            
-        price_history_data_to_insert = [price_history_dict[price_history_id] for price_history_id in new_price_history_id_list]
-        if not price_history_data_to_insert:
-            return False
-        
-        with session_scope() as session:
-            session.bulk_insert_mappings(FirstPriceHistory, price_history_data_to_insert)
-            session.commit()
-        return True
-    
+        with session_scope(raise_error=True) as session:
+            counts = bulk_insert_new(session, FirstPriceHistory, price_history_dict)
+        logger_1st.info(f'bulk_insert_price_history_data(): inserted {counts["inserted"]}, skipped {counts["skipped"]}')
+        return counts
+
     except Exception as e:
         logger_1st.error(f'bulk_insert_price_history_data(): {e}')
         logger_1st.error(traceback.format_exc())
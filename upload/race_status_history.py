@@ -1,5 +1,6 @@
 import traceback
 from database.general import session_scope, FirstRaceStatusHistory
+from database.bulk import bulk_insert_new
 from utils.logger import logger_1st
 
 
@@ -37,29 +38,17 @@ def upload_race_status_history_data(race_status_history: dict, overwrite: bool =
 def bulk_insert_race_status_history_data(race_status_history_dict: dict):
     '''
     bulk insert race status history data received from pull method, which we pull from 1st's API.
+    returns inserted/skipped counts.
     '''
     if not race_status_history_dict:
         return False
-    
+
     try:
-        race_status_history_id_list = list(race_status_history_dict.keys())
-        if not race_status_history_id_list:
-            return False
-        
-        with session_scope() as session:
-            existing_race_status_history_id_list = session.query(FirstRaceStatusHistory.race_status_id).all()
-            existing_race_status_history_id_list = [race_status_history_id[0] for race_status_history_id in existing_race_status_history_id_list]
-            new_race_status_history_id_list = [race_status_history_id for race_status_history_id in race_status_history_id_list if race_status_history_id not in existing_race_status_history_id_list]
+        with session_scope(raise_error=True) as session:
+            counts = bulk_insert_new(session, FirstRaceStatusHistory, race_status_history_dict)
+        logger_1st.info(f'bulk_insert_race_status_history_data(): inserted {counts["inserted"]}, skipped {counts["skipped"]}')
+        return counts
 
-        race_status_history_data_to_insert = [race_status_history_dict[race_status_history_id] for race_status_history_id in new_race_status_history_id_list]
-        if not race_status_history_data_to_insert:
-            return False
-        
-        with session_scope() as session:
-            session.bulk_insert_mappings(FirstRaceStatusHistory, race_status_history_data_to_insert)
-            session.commit()
-        return True
-    
     except Exception as e:
         logger_1st.error(f'bulk_insert_race_status_history_data(): {e}')
         logger_1st.error(traceback.format_exc())
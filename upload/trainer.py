@@ -1,5 +1,6 @@
 import traceback
 from database.general import session_scope, FirstTrainer
+from database.bulk import bulk_insert_new
 from utils.logger import logger_1st
 
 
@@ -32,29 +33,17 @@ def upload_trainer_data(trainer: dict, overwrite: bool = False):
 def bulk_insert_trainer_data(trainer_dict: dict):
     '''
     bulk insert trainer data received from pull method, which we pull from 1st's API.
+    returns inserted/skipped counts.
     '''
     if not trainer_dict:
         return False
-    
+
     try:
-        trainer_id_list = list(trainer_dict.keys())
-        if not trainer_id_list:
-            return False
-            
-        with session_scope() as session:
-            existing_trainer_id_list = session.query(FirstTrainer.trainer_id).all()
-            existing_trainer_id_list = [trainer_id[0] for trainer_id in existing_trainer_id_list]
-            new_trainer_id_list = [trainer_id for trainer_id in trainer_id_list if trainer_id not in existing_trainer_id_list]
-            
-        trainer_data_to_insert = [trainer_dict[trainer_id] for trainer_id in new_trainer_id_list]
-        if not trainer_data_to_insert:
-            return False
-            
-        with session_scope() as session:
-            session.bulk_insert_mappings(FirstTrainer, trainer_data_to_insert)
-            session.commit()
-        return True
-    
+        with session_scope(raise_error=True) as session:
+            counts = bulk_insert_new(session, FirstTrainer, trainer_dict)
+        logger_1st.info(f'bulk_insert_trainer_data(): inserted {counts["inserted"]}, skipped {counts["skipped"]}')
+        return counts
+
     except Exception as e:
         logger_1st.error(f'bulk_insert_trainer_data(): {e}')
         logger_1st.error(traceback.format_exc())
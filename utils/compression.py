@@ -0,0 +1,60 @@
+import io
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, without it only gzip bodies are accepted
+    zstandard = None
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+FILE_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def get_supported_encodings() -> tuple:
+    return ('gzip', 'zstd') if zstandard is not None else ('gzip',)
+
+
+def get_json_file_extension(content_encoding: str | None) -> str:
+    return '.json' + FILE_EXTENSIONS.get(content_encoding, '')
+
+
+def detect_encoding(data: bytes) -> str | None:
+    if data.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if data.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def compress(data: bytes, encoding: str = 'gzip') -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f'unsupported content encoding: {encoding}')
+
+
+def decompress(data: bytes, encoding: str | None) -> bytes:
+    if not encoding or encoding == 'identity':
+        return data
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    raise ValueError(f'unsupported content encoding: {encoding}')
+
+
+def peek(data: bytes, encoding: str | None, size: int = 64) -> bytes:
+    '''
+    first bytes of the decompressed data, without decompressing the rest.
+    '''
+    if not encoding or encoding == 'identity':
+        return data[:size]
+    if encoding == 'gzip':
+        return zlib.decompressobj(wbits=31).decompress(data, size)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read(size)
+    raise ValueError(f'unsupported content encoding: {encoding}')
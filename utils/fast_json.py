@@ -0,0 +1,58 @@
+import io
+import json
+from typing import Iterator
+from utils.logger import logger_1st
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard library
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # ijson is optional, iter_items() falls back to a full parse
+    ijson = None
+ijson_warned = False
+
+
+def loads(data: str | bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def iter_items(data: bytes, prefix: str) -> Iterator:
+    '''
+    yield the elements of the array at prefix (ijson syntax, e.g. 'fixtures.item') one at a time.
+    with ijson only the current element is built as python objects, numbers come out as int / float like json.loads.
+    without it the document is parsed whole first, same results.
+    '''
+    global ijson_warned
+    if ijson is not None:
+        yield from ijson.items(io.BytesIO(data), prefix, use_float=True)
+        return
+    if not ijson_warned:
+        ijson_warned = True
+        logger_1st.warning('iter_items(): ijson is not installed, bodies are parsed whole instead of one item at a time')
+    *path, last = prefix.split('.')
+    if last != 'item':
+        raise ValueError(f'prefix must end with .item: {prefix}')
+    value = loads(data)
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    yield from value or []
+
+
+def is_json_object(body: bytes) -> bool:
+    '''
+    cheap sanity check for a raw request body: utf-8 text that looks like a single json object.
+    it does not parse the body, full validation happens once in the processor.
+    '''
+    body = body.strip()
+    if not body.startswith(b'{') or not body.endswith(b'}'):
+        return False
+    try:
+        body.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
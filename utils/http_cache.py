@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import traceback
+from utils.compression import compress, decompress
+from utils.logger import logger_1st
+
+
+HTTP_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', 'first_api_cache')
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+class ResponseCache:
+    '''
+    on-disk cache of GET response bodies, two files per url: the raw body gzipped (.body.gz) and a small json sidecar
+    (.meta.json) with its validators: etag / last_modified (sent back as If-None-Match / If-Modified-Since),
+    stored_at (for ttl) and content_hash. processed_hash remembers the content a caller last handled,
+    see has_changed() / mark_processed(). only get_body() reads the body, everything else reads the sidecar.
+    least recently used urls are evicted once the directory grows past max_bytes.
+    '''
+
+    def __init__(self, directory: str = HTTP_CACHE_DIR, max_bytes: int = HTTP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes = {}  # path -> bytes on disk
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if filename.endswith(('.body.gz', '.meta.json')):
+                self._sizes[path] = os.path.getsize(path)
+
+    def get_path(self, url: str) -> str:
+        '''
+        path of url's files without the .body.gz / .meta.json suffix.
+        '''
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def get(self, url: str) -> dict | None:
+        '''
+        the metadata of url's entry, without the body.
+        '''
+        path = f'{self.get_path(url)}.meta.json'
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(f.read())
+            os.utime(path)  # mtime doubles as last access for eviction
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger_1st.error(f'ResponseCache.get(): {url}: {e}')
+            return None
+
+    def get_body(self, url: str) -> bytes | None:
+        try:
+            with open(f'{self.get_path(url)}.body.gz', 'rb') as f:
+                return decompress(f.read(), 'gzip')
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger_1st.error(f'ResponseCache.get_body(): {url}: {e}')
+            return None
+
+    def put(self, url: str, body: bytes, etag: str | None = None, last_modified: str | None = None) -> dict:
+        previous = self.get(url) or {}
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+            'content_hash': hashlib.sha256(body).hexdigest(),
+            'processed_hash': previous.get('processed_hash'),
+        }
+        # body first, so a sidecar never describes a body that was not written
+        if self._write(url, '.body.gz', compress(body, 'gzip')):
+            self._write_meta(url, entry)
+        return entry
+
+    def touch(self, url: str, entry: dict):
+        '''
+        the origin confirmed the entry is still current (304), restart its ttl.
+        '''
+        entry['stored_at'] = time.time()
+        self._write_meta(url, entry)
+
+    def has_changed(self, url: str) -> bool:
+        '''
+        whether the cached content differs from what was last marked processed (true when never processed).
+        '''
+        entry = self.get(url)
+        return entry is None or entry['content_hash'] != entry.get('processed_hash')
+
+    def mark_processed(self, url: str):
+        entry = self.get(url)
+        if entry is not None:
+            entry['processed_hash'] = entry['content_hash']
+            self._write_meta(url, entry)
+
+    def _write_meta(self, url: str, entry: dict):
+        self._write(url, '.meta.json', json.dumps(entry).encode())
+
+    def _write(self, url: str, suffix: str, data: bytes) -> bool:
+        path = f'{self.get_path(url)}{suffix}'
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger_1st.error(f'ResponseCache._write(): {url}: {e}')
+            logger_1st.error(traceback.format_exc())
+            return False
+        with self._lock:
+            self._sizes[path] = len(data)
+            if sum(self._sizes.values()) > self.max_bytes:
+                self._evict()
+        return True
+
+    def _evict(self):
+        def get_mtime(path):
+            for suffix in ('.meta.json', '.body.gz'):
+                try:
+                    return os.path.getmtime(f'{path}{suffix}')
+                except OSError:
+                    pass
+            return 0
+
+        # a url's body and sidecar are evicted together, by the last access of the sidecar
+        # (of the body while put() has not written the sidecar yet)
+        sizes = {}
+        for path, size in self._sizes.items():
+            base = path.removesuffix('.body.gz').removesuffix('.meta.json')
+            sizes[base] = sizes.get(base, 0) + size
+        total = sum(sizes.values())
+        for base in sorted(sizes, key=get_mtime):
+            if total <= self.max_bytes * 0.9:
+                break
+            total -= sizes[base]
+            for path in (f'{base}.body.gz', f'{base}.meta.json'):
+                self._sizes.pop(path, None)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    '''
+    process-wide cache in HTTP_CACHE_DIR, created on first use.
+    '''
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+        return response_cache
@@ -0,0 +1,47 @@
+import os
+import base64
+from database.claim_check import needs_claim_check, store_payload, load_payload, make_pointer_message, is_claim_check, get_pointer
+from utils.compression import compress
+
+
+# push bodies travel through sqs compressed: base64 of the compressed bytes plus a content_encoding attribute
+CONTENT_ENCODING_ATTRIBUTE = 'content_encoding'
+QUEUE_COMPRESSION = os.environ.get('QUEUE_COMPRESSION', 'gzip')
+QUEUE_COMPRESSION_THRESHOLD = int(os.environ.get('QUEUE_COMPRESSION_THRESHOLD', 1024))
+
+
+def build_queue_message(body: bytes, content_encoding: str | None = None) -> tuple[str, dict]:
+    '''
+    sqs body and message attributes for a push body, which may already be compressed (content_encoding).
+    uncompressed bodies above QUEUE_COMPRESSION_THRESHOLD are compressed, and anything still too large for sqs
+    is stored behind a claim check.
+    '''
+    if content_encoding is None and QUEUE_COMPRESSION and len(body) > QUEUE_COMPRESSION_THRESHOLD:
+        body = compress(body, QUEUE_COMPRESSION)
+        content_encoding = QUEUE_COMPRESSION
+
+    attributes = {}
+    if content_encoding:
+        message_body = base64.b64encode(body).decode('ascii')
+        attributes[CONTENT_ENCODING_ATTRIBUTE] = {'DataType': 'String', 'StringValue': content_encoding}
+    else:
+        message_body = body.decode('utf-8')
+
+    if needs_claim_check(message_body.encode()):
+        pointer = store_payload(body, content_encoding=content_encoding)
+        return make_pointer_message(pointer)
+    return message_body, attributes
+
+
+def read_message_payload(message: dict) -> tuple[bytes, str | None]:
+    '''
+    the stored bytes of a push message and their content encoding, following claim-check pointers.
+    '''
+    if is_claim_check(message):
+        pointer = get_pointer(message)
+        return load_payload(pointer), pointer.get('content_encoding')
+
+    content_encoding = message.get('MessageAttributes', {}).get(CONTENT_ENCODING_ATTRIBUTE, {}).get('StringValue')
+    if content_encoding:
+        return base64.b64decode(message['Body']), content_encoding
+    return message['Body'].encode(), None
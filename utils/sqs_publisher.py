@@ -0,0 +1,137 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from utils.logger import logger_1st
+
+
+class SQSBatchPublisher:
+    '''
+    asyncio front for a blocking boto3 sqs client.
+    messages published within linger_ms of each other are coalesced into send_message_batch calls,
+    which run on a dedicated thread pool so the event loop never waits on an sqs round trip.
+    publish() returns only once sqs has accepted the message and raises if it was rejected.
+    '''
+
+    MAX_BATCH_ENTRIES = 10
+    MAX_BATCH_BYTES = 250 * 1024  # sqs caps a whole batch at 256 KB, keep some room for attributes
+
+    def __init__(self, client, queue_url: str, linger_ms: float = 5, max_workers: int = 4):
+        self.client = client
+        self.queue_url = queue_url
+        self.linger = linger_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sqs-publisher')
+        self._queue = None
+        self._task = None
+        self._carry = None
+        self._batch = []  # being assembled by _run, not yet handed to _send
+        self._sends = set()
+        self._stopped = object()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_run_done)
+
+    async def stop(self):
+        '''
+        send everything published so far, wait for the sends and shut the pool down.
+        whatever could not be sent (the batching task died) fails instead of waiting forever.
+        '''
+        task, self._task = self._task, None
+        if task and not task.done():
+            await self._queue.put(self._stopped)
+            await asyncio.gather(task, return_exceptions=True)
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+        self._fail_pending(RuntimeError('SQSBatchPublisher stopped'))
+        self._executor.shutdown(wait=True)
+
+    async def publish(self, body: str, attributes: dict | None = None):
+        if self._task is None or self._task.done():
+            raise RuntimeError('SQSBatchPublisher is not running')
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((body, attributes, future, self.get_size(body, attributes)))
+        return await future
+
+    @staticmethod
+    def get_size(body: str | bytes, attributes: dict | None) -> int:
+        size = len(body.encode()) if isinstance(body, str) else len(body)
+        for name, value in (attributes or {}).items():
+            size += len(name) + len(str(value.get('StringValue', ''))) + len(value.get('DataType', ''))
+        return size
+
+    def _on_run_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        logger_1st.error(f'SQSBatchPublisher._run(): {task.exception()}')
+        self._fail_pending(task.exception())
+
+    def _fail_pending(self, error: Exception):
+        items = self._batch + ([self._carry] if self._carry else [])
+        self._batch, self._carry = [], None
+        while self._queue is not None and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        for item in items:
+            if item is not self._stopped and not item[2].done():
+                item[2].set_exception(error)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = self._carry or await self._queue.get()
+            self._carry = None
+            if item is self._stopped:
+                return
+            batch = self._batch = [item]
+            size = item[3]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.MAX_BATCH_ENTRIES:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                # the stop marker is handled once the current batch is sent
+                if item is self._stopped or size + item[3] > self.MAX_BATCH_BYTES:
+                    self._carry = item
+                    break
+                batch.append(item)
+                size += item[3]
+
+            self._batch = []
+            task = asyncio.create_task(self._send(batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, batch: list):
+        entries = []
+        for i, (body, attributes, _, _) in enumerate(batch):
+            entry = {'Id': str(i), 'MessageBody': body}
+            if attributes:
+                entry['MessageAttributes'] = attributes
+            entries.append(entry)
+
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self._executor, partial(self.client.send_message_batch, QueueUrl=self.queue_url, Entries=entries)
+            )
+        except Exception as e:
+            logger_1st.error(f'SQSBatchPublisher._send(): {e}')
+            logger_1st.error(traceback.format_exc())
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        failed = {failure['Id']: failure for failure in response.get('Failed', [])}
+        for i, (_, _, future, _) in enumerate(batch):
+            if future.done():
+                continue
+            if str(i) in failed:
+                logger_1st.error(f'SQSBatchPublisher._send(): {failed[str(i)]}')
+                future.set_exception(RuntimeError(failed[str(i)].get('Message', 'send_message_batch entry failed')))
+            else:
+                future.set_result(True)
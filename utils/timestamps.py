@@ -0,0 +1,21 @@
+from datetime import datetime
+from functools import lru_cache
+from dateutil.parser import parse
+
+
+# price and status histories are re-sent in full with every push, so the same raw strings come back constantly
+TIMESTAMP_CACHE_SIZE = 262_144
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value: str) -> datetime:
+    '''
+    parse a 1st timestamp string, memoized on the raw string.
+    ISO-8601 goes through datetime.fromisoformat, anything it rejects falls back to dateutil.
+    both give the same datetime for ISO-8601 input (including the Z suffix and 7 digit fractions),
+    so ids hashed from str(timestamp) are unchanged.
+    '''
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parse(value)
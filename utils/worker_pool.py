@@ -0,0 +1,75 @@
+import queue
+import threading
+import traceback
+import zlib
+from utils.logger import logger_1st
+
+
+class KeyedWorkerPool:
+    '''
+    pool of worker threads where every item with the same key goes to the same worker, so items for one key
+    are handled in submission order while different keys run in parallel.
+    submit() blocks once max_in_flight items are queued or being handled.
+    each worker hands the handler up to batch_size items at a time.
+    '''
+
+    def __init__(self, handler, num_workers: int = 4, max_in_flight: int = 100, batch_size: int = 10, name: str = 'worker'):
+        self.handler = handler
+        self.num_workers = max(1, num_workers)
+        self.batch_size = batch_size
+        self.name = name
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._queues = [queue.Queue() for _ in range(self.num_workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f'{name}-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        self._stopped = object()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def submit(self, key, item):
+        self._slots.acquire()
+        self._queues[self.get_worker_index(key)].put(item)
+
+    def get_worker_index(self, key) -> int:
+        # crc32 rather than hash() so routing is stable across restarts
+        return zlib.crc32(str(key).encode()) % self.num_workers
+
+    def stop(self, wait: bool = True):
+        for q in self._queues:
+            q.put(self._stopped)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is self._stopped:
+                return
+            items = [item]
+            stop_after = False
+            while len(items) < self.batch_size:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._stopped:
+                    stop_after = True
+                    break
+                items.append(item)
+
+            try:
+                self.handler(items)
+            except Exception as e:
+                logger_1st.error(f'KeyedWorkerPool({self.name}): {e}')
+                logger_1st.error(traceback.format_exc())
+            finally:
+                for _ in items:
+                    self._slots.release()
+            if stop_after:
+                return